@@ -3,14 +3,33 @@ from gevent.monkey import patch_all; patch_all()
 from pywb.apps.frontendapp import FrontEndApp
 
 import os
+import copy
+import gzip
+import hashlib
+import json
 import logging
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from io import BytesIO
 
 from pywb.apps.cli import ReplayCli
 from werkzeug.routing import Map, Rule
 from pywb.apps.wbrequestresponse import WbResponse
 from pywb.warcserver.warcserver import register_source
 from pywb.warcserver.index.indexsource import LiveIndexSource, FileIndexSource, NotFoundException
+from pywb.warcserver.index.zipnum import ZipNumIndexSource
+from pywb.warcserver.index.aggregator import DirectoryIndexSource
+from pywb.warcserver.http import DefaultAdapters
+from pywb.warcserver.resource.responseloader import LiveWebLoader
+from pywb.utils.io import call_release_conn
+from warcio.statusandheaders import StatusAndHeadersParser
 from pywb.recorder.filters import SkipDefaultFilter
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager, HTTPConnectionPool, HTTPSConnectionPool, Timeout
+from urllib3.util import parse_url
 
 
 # ============================================================================
@@ -18,10 +37,70 @@ class DynProxyPywb(FrontEndApp):
     def __init__(self, config_file='./config.yaml', custom_config=None):
         register_source(PrefixFilterIndexSource)
         register_source(FileFilterIndexSource)
+        register_source(FilterDirectoryIndexSource)
+
+        # pywb's LiveWebLoader fetches live_filter resources with this adapter
+        DefaultAdapters.live_adapter = BackendAdapter()
 
         super(DynProxyPywb, self).__init__(config_file=config_file,
                                            custom_config=custom_config)
 
+        response_cache = ResponseCache.from_environ()
+        if response_cache:
+            self.install_live_loader(CachingLiveWebLoader(response_cache))
+
+        self.rewriterapp._add_custom_params = self.add_source_header
+
+        metrics.add_collector(DefaultAdapters.live_adapter.metric_values)
+
+    def _init_routes(self):
+        super(DynProxyPywb, self)._init_routes()
+        self.url_map.add(Rule('/metrics', endpoint=self.serve_metrics))
+
+    def serve_metrics(self, environ):
+        return WbResponse.text_response(
+            metrics.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def handle_request(self, environ, start_response):
+        if environ.get('PATH_INFO') == '/metrics':
+            return super(DynProxyPywb, self).handle_request(environ,
+                                                            start_response)
+
+        start = time.time()
+        status = []
+
+        def record_status(status_line, headers, *args):
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, *args)
+
+        try:
+            return super(DynProxyPywb, self).handle_request(environ,
+                                                            record_status)
+        finally:
+            metrics.observe('rpz_request_seconds', time.time() - start)
+            metrics.inc('rpz_requests_total',
+                        {'code': status[0] if status else '500'})
+
+    @staticmethod
+    def add_source_header(cdx, headers, kwargs, record):
+        # tells clients such as `reprounzip dj bench` which source of the
+        # sequence (store or reprozip) served the response
+        source = headers.get('Warcserver-Source-Coll')
+        if source and record.http_headers:
+            record.http_headers.replace_header('X-Rpz-Source', source)
+
+    def install_live_loader(self, live_loader):
+        handlers = list(self.warcserver.fixed_routes.values())
+        if self.warcserver.auto_handler:
+            handlers.append(self.warcserver.auto_handler)
+
+        for handler in handlers:
+            for res_handler in getattr(handler, 'handlers', [handler]):
+                loaders = getattr(res_handler, 'resource_loaders', [])
+                for i, loader in enumerate(loaders):
+                    if type(loader) is LiveWebLoader:
+                        loaders[i] = live_loader
 
     def proxy_route_request(self, url, environ):
         key = 'ip:' + environ['REMOTE_ADDR']
@@ -32,18 +111,268 @@ class DynProxyPywb(FrontEndApp):
             return super(DynProxyPywb, self).proxy_route_request(url, environ)
 
 
+#=============================================================================
+class Metrics(object):
+    """ Prometheus counters and latency histograms. uwsgi runs the app in
+    several worker processes, so each worker writes its values to its own
+    file in RPZ_METRICS_DIR, at most every FLUSH_INTERVAL seconds, and
+    /metrics adds up the files of all the workers.
+    """
+    FLUSH_INTERVAL = 1.0
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0)
+    HELP = OrderedDict([
+        ('rpz_requests_total',
+         ('counter', 'Requests served, by status code')),
+        ('rpz_request_seconds',
+         ('histogram', 'Time until a request starts its response')),
+        ('rpz_index_lookups_total',
+         ('counter', 'Index lookups by source and result (hit, empty, '
+                     'not_found when the source raised NotFoundException)')),
+        ('rpz_index_lookup_seconds',
+         ('histogram', 'Time of index lookups by source')),
+        ('rpz_index_cache_entries',
+         ('gauge', 'Entries in the index lookup caches')),
+        ('rpz_index_cache_hits_total',
+         ('counter', 'Index lookups answered by the lookup cache')),
+        ('rpz_index_cache_misses_total',
+         ('counter', 'Index lookups that missed the lookup cache')),
+        ('rpz_live_requests_total',
+         ('counter', 'Requests to the site containers by backend and '
+                     'result (error for 5xx responses and failures)')),
+        ('rpz_live_request_seconds',
+         ('histogram', 'Time until a site container sends its headers')),
+        ('rpz_live_connections_in_use',
+         ('gauge', 'Connections to the site containers checked out')),
+        ('rpz_live_connections_opened_total',
+         ('counter', 'Connections opened to the site containers')),
+    ])
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get(
+                'RPZ_METRICS_DIR',
+                os.path.join(tempfile.gettempdir(), 'rpz-metrics'))
+        self.directory = directory
+        self.values = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.filename = None
+        self.pid = None
+        self.flushed = 0
+
+        # the app is loaded once in the uwsgi master, before the workers are
+        # forked: files left over from an earlier run are stale
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            if name.startswith('worker-') and name.endswith('.json'):
+                os.remove(os.path.join(directory, name))
+
+    @staticmethod
+    def key(name, labels=None):
+        if not labels:
+            return name
+        return '{0}{{{1}}}'.format(name, ','.join(
+            '{0}="{1}"'.format(k, str(labels[k]).replace('"', '\\"'))
+            for k in sorted(labels)))
+
+    @staticmethod
+    def name(key):
+        name = key.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in Metrics.HELP:
+                return name[:-len(suffix)]
+        return name
+
+    def add_collector(self, collector):
+        """ Registers a function returning values read at flush time, such
+        as cache sizes and connection pool counters
+        """
+        self.collectors.append(collector)
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, seconds, labels=None):
+        labels = labels or {}
+        with self.lock:
+            for bound in self.BUCKETS + ('+Inf',):
+                key = self.key(name + '_bucket', dict(labels, le=str(bound)))
+                hit = bound == '+Inf' or seconds <= bound
+                self.values[key] = self.values.get(key, 0) + int(hit)
+            for suffix, value in (('_sum', seconds), ('_count', 1)):
+                key = self.key(name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + value
+        self.maybe_flush()
+
+    def lookup(self, source, load_index, params):
+        """ Runs an index lookup, counting its result and timing it
+        """
+        start = time.time()
+        result = 'error'
+        try:
+            cdxs = list(load_index(params))
+        except NotFoundException:
+            result = 'not_found'
+            raise
+        else:
+            result = 'hit' if cdxs else 'empty'
+        finally:
+            labels = {'source': source}
+            self.observe('rpz_index_lookup_seconds', time.time() - start,
+                         labels)
+            self.inc('rpz_index_lookups_total', dict(labels, result=result))
+
+        return iter(cdxs)
+
+    def maybe_flush(self):
+        if time.time() - self.flushed >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        # a worker forked from the master starts its own file
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.filename = os.path.join(
+                self.directory,
+                'worker-{0}-{1}.json'.format(self.pid, uuid.uuid4().hex[:8]))
+
+        with self.lock:
+            values = dict(self.values)
+            self.flushed = time.time()
+        for collector in self.collectors:
+            for key, value in collector().items():
+                values[key] = values.get(key, 0) + value
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(values, fp)
+        os.replace(tmp, self.filename)
+
+    def collect(self):
+        """ Adds up the values written by all the live workers
+        """
+        self.flush()
+
+        totals = {}
+        for name in os.listdir(self.directory):
+            if not (name.startswith('worker-') and name.endswith('.json')):
+                continue
+            # uwsgi respawns workers that die or reach their request limit:
+            # the files of dead ones would keep their gauges forever, and
+            # Prometheus takes the drop in their counters for a reset
+            if not self.alive(int(name.split('-')[1])):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as fp:
+                    values = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            for key, value in values.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    @staticmethod
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def render(self):
+        """ Returns the values in the Prometheus text exposition format
+        """
+        by_name = {}
+        for key, value in self.collect().items():
+            by_name.setdefault(self.name(key), []).append((key, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, doc = self.HELP.get(name, ('untyped', name))
+            lines.append('# HELP {0} {1}'.format(name, doc))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for key, value in sorted(by_name[name], key=self.sort_key):
+                lines.append('{0} {1}'.format(key, value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def sort_key(item):
+        # keeps the buckets of a histogram in increasing order of le
+        key = item[0]
+        if '_bucket{' in key:
+            le = key.split('le="', 1)[1].split('"', 1)[0]
+            return key.replace('le="' + le + '"', ''), float(le)
+        return key, 0.0
+
+
+metrics = Metrics()
+
+
 #=============================================================================
 class SkipHtmlFilter(SkipDefaultFilter):
     pass
 
 
+#=============================================================================
+class RouteTable(object):
+    """ Maps the fake origins of packaged sites (scheme://host) to the live
+    backend serving each of them. RPZ_FAKE_URL / RPZ_HOST give one route,
+    RPZ_ROUTES adds more as whitespace or comma separated fake=backend pairs,
+    e.g. RPZ_ROUTES="http://a.rpz=site-a:3000 http://b.rpz=site-b:80"
+    """
+    def __init__(self, routes):
+        self.routes = dict((self.origin(fake), backend)
+                           for fake, backend in routes.items())
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        routes = {}
+        fake_url = environ.get('RPZ_FAKE_URL', 'http://datajournalism.rpz')
+        if fake_url:
+            routes[fake_url] = environ.get('RPZ_HOST')
+
+        for route in environ.get('RPZ_ROUTES', '').replace(',', ' ').split():
+            fake_url, backend = route.split('=', 1)
+            routes[fake_url] = backend
+
+        return cls(routes)
+
+    @staticmethod
+    def origin(url):
+        scheme, _, rest = url.partition('://')
+        return scheme.lower() + '://' + rest.split('/', 1)[0].lower()
+
+    def lookup(self, url):
+        """ Returns the backend for url and the url's length of origin, or
+        None when url is not on a packaged site
+        """
+        origin = self.origin(url)
+        backend = self.routes.get(origin)
+        if backend is None:
+            return None
+
+        return backend, len(origin)
+
+    def __bool__(self):
+        return bool(self.routes)
+
+
 #=============================================================================
 class PrefixFilterIndexSource(LiveIndexSource):
     def __init__(self):
         super(LiveIndexSource, self).__init__()
-        self.filter_prefix = os.environ.get('RPZ_FAKE_URL', 'http://datajournalism.rpz')
-
-        self.redirect_prefix = os.environ.get('RPZ_HOST')
+        self.routes = RouteTable.from_environ()
 
     # def load_index(self, params):
     #     cdx_iterator = super(PrefixFilterIndexSource, self).load_index(params)
@@ -51,12 +380,19 @@ class PrefixFilterIndexSource(LiveIndexSource):
     #     cdx['is_live'] = 'false'
     #     return iter([cdx])
 
+    def load_index(self, params):
+        return metrics.lookup(
+            'live_filter', super(PrefixFilterIndexSource, self).load_index,
+            params)
+
     def get_load_url(self, params):
         url = params['url']
 
-        if self.filter_prefix:
-            if  url.startswith(self.filter_prefix):
-                url = self.redirect_prefix + url[len(self.filter_prefix):]
+        if self.routes:
+            route = self.routes.lookup(url)
+            if route:
+                backend, origin_len = route
+                url = backend + url[origin_len:]
             else:
                 raise NotFoundException('Skipping: ' + url)
 
@@ -74,24 +410,395 @@ class PrefixFilterIndexSource(LiveIndexSource):
         return None
 
 
+#=============================================================================
+class LookupCache(object):
+    """ LRU cache of index lookups, keyed on the SURT key range of the query.
+    Lookups that found nothing, or raised NotFoundException, are cached too.
+    """
+    def __init__(self, max_size=None, source='file_filter'):
+        if max_size is None:
+            max_size = int(os.environ.get('RPZ_INDEX_CACHE_SIZE', 10000))
+        self.max_size = max_size
+        self.source = source
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+        metrics.add_collector(self.metric_values)
+
+    def lookup(self, params, load_index):
+        key = (params['key'], params['end_key'])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if not entry or isinstance(entry, NotFoundException):
+                    self.negative_hits += 1
+
+        if entry is None:
+            try:
+                entry = list(load_index(params))
+            except NotFoundException as e:
+                entry = e
+
+            with self.lock:
+                self.entries[key] = entry
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        if isinstance(entry, NotFoundException):
+            raise entry
+
+        # callers annotate the cdx objects they get, so hand out copies
+        return iter([copy.copy(cdx) for cdx in entry])
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'negative_hits': self.negative_hits}
+
+    def metric_values(self):
+        stats = self.stats()
+        labels = {'source': self.source}
+        return {
+            Metrics.key('rpz_index_cache_entries', labels): stats['size'],
+            Metrics.key('rpz_index_cache_hits_total', labels): stats['hits'],
+            Metrics.key('rpz_index_cache_misses_total', labels):
+                stats['misses'],
+        }
+
+
+#=============================================================================
+class CountingPoolMixin(object):
+    """ Tracks how many connections of a pool are checked out, to tell
+    whether the pool is large enough for the request concurrency
+    """
+    in_use = 0
+    peak_in_use = 0
+    discarded = 0
+
+    def _get_conn(self, timeout=None):
+        conn = super(CountingPoolMixin, self)._get_conn(timeout)
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return conn
+
+    def _put_conn(self, conn):
+        self.in_use -= 1
+        if self.pool is not None and self.pool.full():
+            self.discarded += 1
+
+        super(CountingPoolMixin, self)._put_conn(conn)
+
+    def stats(self):
+        return {'maxsize': self.pool.maxsize if self.pool else 0,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'idle': sum(1 for c in self.pool.queue if c) if self.pool else 0,
+                'connections_opened': self.num_connections,
+                'requests': self.num_requests,
+                'discarded': self.discarded}
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+#=============================================================================
+class BackendPoolManager(PoolManager):
+    """ One keep-alive connection pool per backend host, with timeouts
+    applied even when the caller passes none
+    """
+    def __init__(self, timeout, **kwargs):
+        super(BackendPoolManager, self).__init__(**kwargs)
+        self.default_timeout = timeout
+        self.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                       'https': CountingHTTPSConnectionPool}
+
+    def urlopen(self, method, url, redirect=True, **kw):
+        if kw.get('timeout') is None:
+            kw['timeout'] = self.default_timeout
+
+        headers = kw.get('headers')
+        if headers is not None:
+            for name in [n for n in headers if n.lower() == 'connection']:
+                del headers[name]
+            headers['Connection'] = 'keep-alive'
+
+        # pywb's LiveWebLoader calls urlopen directly, not the adapter's send
+        labels = {'backend': parse_url(url).netloc}
+        start = time.time()
+        try:
+            response = super(BackendPoolManager, self).urlopen(
+                method, url, redirect=redirect, **kw)
+        except Exception:
+            metrics.inc('rpz_live_requests_total',
+                        dict(labels, result='error'))
+            raise
+
+        metrics.observe('rpz_live_request_seconds', time.time() - start,
+                        labels)
+        metrics.inc('rpz_live_requests_total',
+                    dict(labels, result='error'
+                         if response.status >= 500 else 'ok'))
+        return response
+
+    def stats(self):
+        stats = {}
+        for key in self.pools.keys():
+            pool = self.pools.get(key)
+            if pool is not None:
+                stats['{0}:{1}'.format(pool.host, pool.port)] = pool.stats()
+        return stats
+
+
+#=============================================================================
+class BackendAdapter(HTTPAdapter):
+    """ Adapter for live loads from the packaged sites' containers. The pool
+    size defaults to the number of gevent workers of a uwsgi process so that
+    connections are reused rather than opened and dropped under load.
+    """
+    def __init__(self):
+        self.pool_size = int(os.environ.get('RPZ_POOL_SIZE', 100))
+        self.timeout = Timeout(
+            connect=float(os.environ.get('RPZ_CONNECT_TIMEOUT', 5)),
+            read=float(os.environ.get('RPZ_READ_TIMEOUT', 60)))
+
+        super(BackendAdapter, self).__init__(pool_maxsize=self.pool_size,
+                                             max_retries=3)
+
+    def init_poolmanager(self, connections, maxsize, block=False,
+                         **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = BackendPoolManager(self.timeout,
+                                              num_pools=connections,
+                                              maxsize=maxsize,
+                                              block=block,
+                                              **pool_kwargs)
+
+    def stats(self):
+        return self.poolmanager.stats()
+
+    def metric_values(self):
+        values = {}
+        for backend, stats in self.stats().items():
+            labels = {'backend': backend}
+            values[Metrics.key('rpz_live_connections_in_use', labels)] = \
+                stats['in_use']
+            values[Metrics.key('rpz_live_connections_opened_total',
+                               labels)] = stats['connections_opened']
+        return values
+
+
+#=============================================================================
+class ResponseCache(object):
+    """ Disk cache of GET responses from the packaged sites' containers,
+    stored as uncompressed WARC records without the trailing newlines.
+    Enabled by setting RPZ_RESPONSE_CACHE_DIR. Entries are keyed on the URL
+    and the request headers listed in RPZ_RESPONSE_CACHE_VARY, and the least
+    recently used are removed once the cache grows past
+    RPZ_RESPONSE_CACHE_SIZE bytes. With RPZ_RESPONSE_CACHE_WARC_DIR set,
+    every response stored is also appended to a WARC in that directory.
+    """
+    DEFAULT_VARY = 'Accept,Accept-Encoding,Accept-Language,Cookie'
+
+    def __init__(self, cache_dir, max_size, max_entry_size, vary,
+                 warc_dir=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.vary = [name.strip().lower() for name in vary.split(',')]
+        self.warc_dir = warc_dir
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.size = self.disk_usage()[0]
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        cache_dir = environ.get('RPZ_RESPONSE_CACHE_DIR')
+        if not cache_dir:
+            return None
+
+        return cls(cache_dir,
+                   int(environ.get('RPZ_RESPONSE_CACHE_SIZE', 1 << 30)),
+                   int(environ.get('RPZ_RESPONSE_CACHE_MAX_ENTRY', 10 << 20)),
+                   environ.get('RPZ_RESPONSE_CACHE_VARY', cls.DEFAULT_VARY),
+                   environ.get('RPZ_RESPONSE_CACHE_WARC_DIR'))
+
+    def key(self, url, req_headers):
+        headers = dict((n.lower(), v) for n, v in req_headers.items())
+        parts = [url] + [headers.get(name, '') for name in self.vary]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return None
+
+        os.utime(path, None)
+
+        warc_headers = StatusAndHeadersParser(['WARC/1.0']).parse(fh)
+        http_headers = b''
+        while True:
+            line = fh.readline()
+            http_headers += line
+            if line in (b'\r\n', b''):
+                break
+
+        return warc_headers, http_headers, fh
+
+    def put(self, key, warc_headers, http_headers, body):
+        warc_headers.replace_header('Content-Length',
+                                    str(len(http_headers) + len(body)))
+        record = warc_headers.to_bytes() + http_headers + body
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(record)
+        os.replace(tmp_path, self.path(key))
+
+        if self.warc_dir:
+            warc_path = os.path.join(self.warc_dir,
+                                     'live-cache-{0}.warc.gz'.format(os.getpid()))
+            with open(warc_path, 'ab') as fh:
+                fh.write(gzip.compress(record + b'\r\n\r\n'))
+
+        with self.lock:
+            self.size += len(record)
+            if self.size > self.max_size:
+                self.evict()
+
+    def disk_usage(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return sum(e[1] for e in entries), entries
+
+    def evict(self):
+        # other uwsgi processes share the directory, so recount from disk
+        self.size, entries = self.disk_usage()
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+#=============================================================================
+class CachingReader(object):
+    """ Passes a response body through, keeping a copy that is handed to
+    on_complete once the whole body was read, unless it grew past max_size
+    """
+    def __init__(self, stream, on_complete, max_size):
+        self.stream = stream
+        self.on_complete = on_complete
+        self.max_size = max_size
+        self.buff = BytesIO()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.buff is not None:
+            if data:
+                self.buff.write(data)
+                if self.buff.tell() > self.max_size:
+                    self.buff = None
+            else:
+                body = self.buff.getvalue()
+                self.buff = None
+                self.on_complete(body)
+
+        return data
+
+    def release_conn(self):
+        with call_release_conn(self.stream):
+            pass
+
+    def close(self):
+        self.release_conn()
+
+
+#=============================================================================
+class CachingLiveWebLoader(LiveWebLoader):
+    def __init__(self, cache, forward_proxy_prefix=None):
+        super(CachingLiveWebLoader, self).__init__(forward_proxy_prefix)
+        self.cache = cache
+
+    def load_resource(self, cdx, params):
+        input_req = params.get('_input_req')
+        if (not cdx.get('is_live') or not cdx.get('load_url') or
+                input_req is None or input_req.get_req_method() != 'GET'):
+            return super(CachingLiveWebLoader, self).load_resource(cdx, params)
+
+        key = self.cache.key(cdx['load_url'], input_req.get_req_headers())
+        entry = self.cache.get(key)
+        if entry:
+            return entry
+
+        entry = super(CachingLiveWebLoader, self).load_resource(cdx, params)
+        if not entry or not isinstance(entry, tuple) or not entry[0]:
+            return entry
+
+        warc_headers, http_headers, stream = entry
+        if http_headers.split(b' ', 2)[1:2] != [b'200']:
+            return entry
+
+        def store(body):
+            try:
+                self.cache.put(key, warc_headers, http_headers, body)
+            except Exception:
+                logging.exception('Could not cache ' + cdx['load_url'])
+
+        return (warc_headers, http_headers,
+                CachingReader(stream, store, self.cache.max_entry_size))
+
+
 #=============================================================================
 class FileFilterIndexSource(FileIndexSource):
     def __init__(self, filename):
         super(FileFilterIndexSource, self).__init__(filename)
 
-        self.filter_prefix = os.environ.get('RPZ_FAKE_URL', 'http://datajournalism.rpz')
+        self.routes = RouteTable.from_environ()
+        self.cache = LookupCache(source='file_filter')
 
     def load_index(self, params):
+        return metrics.lookup('file_filter', self.load_filtered, params)
+
+    def load_filtered(self, params):
         if not self.use_webarchive(params['url']):
             raise NotFoundException('Skipping: ' + params['url'])
 
-        return super(FileFilterIndexSource, self).load_index(params)
+        return self.cache.lookup(
+            params, super(FileFilterIndexSource, self).load_index)
 
     def use_webarchive(self, url):
-        if url.startswith(self.filter_prefix):
-            return False
-        else:
-            return True
+        return self.routes.lookup(url) is None
 
 
     @classmethod
@@ -99,9 +806,74 @@ class FileFilterIndexSource(FileIndexSource):
         if config['type'] != 'file_filter':
             return
 
+        if config['path'].endswith(ZipNumIndexSource.IDX_EXT):
+            return ZipNumFilterIndexSource(config['path'], config)
+
         return cls.init_from_string(config['path'])
 
 
+#=============================================================================
+class ZipNumFilterIndexSource(ZipNumIndexSource):
+    def __init__(self, summary, config=None):
+        super(ZipNumFilterIndexSource, self).__init__(summary, config)
+
+        self.routes = RouteTable.from_environ()
+        self.cache = LookupCache(source='zipnum_filter')
+
+    def load_index(self, params):
+        return metrics.lookup('zipnum_filter', self.load_filtered, params)
+
+    def load_filtered(self, params):
+        if self.routes.lookup(params['url']) is not None:
+            raise NotFoundException('Skipping: ' + params['url'])
+
+        return self.cache.lookup(
+            params, super(ZipNumFilterIndexSource, self).load_index)
+
+
+#=============================================================================
+class FilterDirectoryIndexSource(DirectoryIndexSource):
+    """ A directory of indexes, such as the store's, read through the
+    filter sources above. pywb's directory source builds new sources for
+    every lookup, which would leave their lookup caches empty, so these are
+    kept per file: the indexes of a package don't change while it is served.
+    """
+    def __init__(self, base_prefix, base_dir='', name='', config=None):
+        super(FilterDirectoryIndexSource, self).__init__(
+            base_prefix, base_dir, name, config)
+
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def _load_files_single_dir(self, the_dir):
+        for name in sorted(os.listdir(the_dir)):
+            filename = os.path.join(the_dir, name)
+            with self.lock:
+                if filename not in self.sources:
+                    self.sources[filename] = self.filter_source(filename)
+                index_src = self.sources[filename]
+
+            if index_src is None:
+                continue
+
+            rel_path = os.path.relpath(the_dir, self.base_prefix)
+            full_name = name if rel_path == '.' else os.path.join(rel_path,
+                                                                  name)
+            if self.name:
+                full_name = self.name + ':' + full_name
+
+            yield full_name, index_src
+
+    def filter_source(self, filename):
+        if filename.endswith(FileIndexSource.CDX_EXT):
+            return FileFilterIndexSource(filename)
+
+        if filename.endswith(ZipNumIndexSource.IDX_EXT):
+            return ZipNumFilterIndexSource(filename, self.config)
+
+        return None
+
+
 #=============================================================================
 class WaybackCli(ReplayCli):
     def load(self):
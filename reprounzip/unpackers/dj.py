@@ -1,21 +1,45 @@
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import fcntl
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import itertools
 from pathlib import Path
 import logging
+import mimetypes
+import multiprocessing
+import multiprocessing.connection
 import sys
 import subprocess
 import signal
+import socket
 import time
+import uuid
 import requests
-import websocket
+import rpaths
 import json
 import docker
 import docker.errors
-import pychrome
 import os
+import re
 import shutil
 import tarfile
-from reprounzip.common import RPZPack
-from reprounzip.unpackers.docker import docker_setup, docker_run, read_dict
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from xml.etree import ElementTree
+from reprounzip.common import RPZPack, load_config
+from reprounzip.unpackers.common import metadata_initial_iofiles
+from reprounzip.unpackers.docker import docker_setup, docker_run, read_dict, \
+    write_dict
 
 
 logger = logging.getLogger('reprounzip.dj')
@@ -37,57 +61,532 @@ class MissingWARCData(Exception):
     pass
 
 
+class ServiceNotReady(TimeoutError):
+    pass
+
+
+class CDPError(Exception):
+    pass
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+WARC_EXTENSIONS = ('.warc', '.warc.gz')
+INDEX_EXTENSIONS = ('.cdxj', '.summary', '.loc', '.cdx.gz')
+PROFILE_EXTENSIONS = ('.har', '.json')
+
+
+# Table of the WARC_DATA members of an RPZ with their data offsets, sizes
+# and SHA-256 digests, stored as the last member of the archive so it can
+# be found from the end of the file without reading every member header
+class WARCIndex(object):
+    NAME = 'WARC_DATA/index.json'
+    SEARCH_LIMIT = 1 << 20
+    CHUNK_SIZE = 1 << 20
+
+    @classmethod
+    def read(cls, rpz_file):
+        return cls.locate(rpz_file)[0]
+
+    @classmethod
+    def locate(cls, rpz_file):
+        """Returns the index and the offset right after it, where the
+        archive ends and new members can be written, or (None, None)
+        """
+        with open(str(rpz_file), 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end - end % tarfile.BLOCKSIZE
+            while pos > max(0, end - cls.SEARCH_LIMIT):
+                pos -= tarfile.BLOCKSIZE
+                f.seek(pos)
+                buf = f.read(tarfile.BLOCKSIZE)
+                if buf == tarfile.NUL * tarfile.BLOCKSIZE:
+                    continue
+                try:
+                    info = tarfile.TarInfo.frombuf(buf, tarfile.ENCODING,
+                                                   'surrogateescape')
+                except tarfile.HeaderError:
+                    continue
+                if info.name == cls.NAME:
+                    blocks = -(-info.size // tarfile.BLOCKSIZE)
+                    return (json.loads(f.read(info.size).decode()),
+                            pos + (1 + blocks) * tarfile.BLOCKSIZE)
+        return None, None
+
+    @staticmethod
+    def digest(entry):
+        # packages written before the digests were added have none
+        return entry[2] if len(entry) > 2 else None
+
+    @classmethod
+    def extract(cls, rpz_file, index, name, dest):
+        """Copies a member to dest and returns the SHA-256 of its data
+        """
+        offset, size = index[name][:2]
+        digest = hashlib.sha256()
+        written = 0
+        with open(str(rpz_file), 'rb') as src, open(str(dest), 'wb') as dst:
+            src.seek(offset)
+            reader = io.BufferedReader(LimitedReader(src, size),
+                                       cls.CHUNK_SIZE)
+            for chunk in iter(lambda: reader.read(cls.CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+                written += len(chunk)
+        if written != size:
+            raise InvalidRPZ('{} is truncated: {} of {} bytes'.format(
+                name, written, size))
+        return digest.hexdigest()
+
+
+class LimitedReader(io.RawIOBase):
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fileobj.read(min(len(b), self.remaining))
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+
 class WARCPacker(object):
 
     @staticmethod
     def no_second_pass(rpz_file):
-        with tarfile.open(str(rpz_file)) as tar:
-            for name in tar.getnames():
-                if name[0:9] == 'WARC_DATA':
-                    raise InvalidRPZ(
-                        'This RPZ archive '
-                        'already contains WARC data')
+        if WARCIndex.read(rpz_file) is None:
+            # packed before the index existed: look for WARC_DATA members
+            with tarfile.open(str(rpz_file), 'r:') as tar:
+                if not any(m.name[0:9] == 'WARC_DATA' for m in tar):
+                    return
+        raise InvalidRPZ('This RPZ archive already contains WARC data')
 
     @staticmethod
     def data_path(filename, prefix=Path('WARC_DATA')):
         return prefix / filename.parts[-1]
 
     def __init__(self, rpz_file):
-        self.tar = tarfile.open(str(rpz_file), 'a:')
-
-    def add_warc_data(self, target, coll='warc-data'):
+        index, end = WARCIndex.locate(rpz_file)
+        if index is None:
+            # no WARC data yet, or packed before the index existed: walk
+            # the member headers to find where the archive ends
+            with tarfile.open(str(rpz_file), 'r:') as tar:
+                index = dict((m.name, [m.offset_data, m.size])
+                             for m in tar.getmembers()
+                             if m.name[0:9] == 'WARC_DATA' and
+                             m.name != WARCIndex.NAME)
+                end = tar.offset
+        self.index = index
+        self.added = False
+        # new members overwrite the end-of-archive blocks, as in 'a' mode
+        # but without reading every header again
+        self.file = open(str(rpz_file), 'r+b')
+        self.end = end
+        self.file.seek(end)
+        self.tail = self.file.read()
+        self.file.seek(end)
+        self.tar = tarfile.open(fileobj=self.file, mode='w')
+
+    def add(self, path):
+        name = str(WARCPacker.data_path(path))
+        self.tar.add(str(path), name, recursive=False)
+        self.added = True
+        size = self.tar.members[-1].size
+        blocks = -(-size // tarfile.BLOCKSIZE)
+        self.index[name] = [self.tar.offset - blocks * tarfile.BLOCKSIZE,
+                            size, file_sha256(path)]
+
+    def add_warc_data(self, target, coll='warc-data', incremental=False):
+        """Packs the WARCs of a collection with their index. With
+        incremental, only the WARCs not packed yet are added, their
+        responses are deduplicated against the packed ones, and a new
+        index covering both replaces the previous one.
+        """
         coll_path = Path(target) / 'collections' / coll
         warc_path = coll_path / 'archive'
-        try:
-            warc = sorted(os.listdir(warc_path))[-1]
-        except IndexError:
+        packed_names = set(Path(name).name for name in self.index)
+        previous = []
+        warcs = warc_files(warc_path)
+        if incremental:
+            warcs = [w for w in warcs if w.name not in packed_names]
+            if not warcs:
+                # every page was already recorded: nothing to add
+                logger.warning("No new WARC data recorded, the package is "
+                               "left unchanged")
+                return
+            previous = packed_index_lines(coll_path)
+        if not warcs:
             raise MissingWARCData(warc_path)
-        warc_path = warc_path / warc
-        index_path = coll_path / 'indexes/autoindex.cdxj'
-        for path in [warc_path, index_path]:
-            self.tar.add(str(path),
-                         str(WARCPacker.data_path(path)),
-                         recursive=False)
+        staging = Path(tempfile.mkdtemp(prefix='rpzdj_'))
+        try:
+            dedup = WARCDeduplicator()
+            dedup.seed(previous)
+            packed = []
+            with tracer.span('dedupe', warcs=len(warcs)) as attrs:
+                for warc in warcs:
+                    packed.append(staging / warc.name)
+                    dedup.dedupe(warc, packed[-1])
+                attrs['responses'] = dedup.responses
+                attrs['revisits'] = dedup.revisits
+            logger.info("Packing {} WARC files, {} of {} responses stored "
+                        "as revisits".format(len(packed), dedup.revisits,
+                                             dedup.responses))
+            index_path = staging / 'autoindex.cdxj'
+            with tracer.span('index'):
+                write_cdxj(index_path, packed, previous)
+                indexes = write_zipnum(index_path)
+            with tracer.span('append') as attrs:
+                files = (packed + indexes +
+                         [path for path in profile_files(
+                             coll_path / 'profiles')
+                          if path.name not in packed_names])
+                for path in files:
+                    self.add(path)
+                attrs['files'] = len(files)
+                attrs['bytes'] = sum(path.stat().st_size for path in files)
+        finally:
+            shutil.rmtree(str(staging))
+
+    def write_index(self):
+        data = json.dumps(self.index, sort_keys=True).encode()
+        info = tarfile.TarInfo(WARCIndex.NAME)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
 
     def close(self):
+        if self.added:
+            self.write_index()
         self.tar.close()
-        self.seen = None
+        self.file.truncate()
+        self.file.close()
+
+    def abort(self):
+        # puts back the end of the archive the added members overwrote
+        self.file.seek(self.end)
+        self.file.write(self.tail)
+        self.file.truncate()
+        self.file.close()
+
+
+# Rewrites WARCs so that a response whose payload was already seen, in the
+# same or an earlier WARC, is stored as a revisit record of the first one
+class WARCDeduplicator(object):
+
+    def __init__(self):
+        self.seen = {}
+        self.responses = 0
+        self.revisits = 0
+
+    def seed(self, cdxj_lines):
+        """Marks the payloads of already packed responses as seen
+        """
+        from warcio.timeutils import timestamp_to_iso_date
+        for line in cdxj_lines:
+            _, timestamp, data = line.split(b' ', 2)
+            cdx = json.loads(data.decode('utf-8'))
+            digest = cdx.get('digest', '-')
+            if cdx.get('mime') == 'warc/revisit' or digest == '-':
+                continue
+            if ':' not in digest:
+                digest = 'sha1:' + digest
+            self.seen.setdefault(digest, (
+                cdx['url'], timestamp_to_iso_date(timestamp.decode())))
+
+    def dedupe(self, src, dest):
+        from warcio.archiveiterator import ArchiveIterator
+        from warcio.warcwriter import WARCWriter
+        with open(str(src), 'rb') as infile, open(str(dest), 'wb') as out:
+            writer = WARCWriter(out, gzip=dest.name.endswith('.gz'))
+            for record in ArchiveIterator(infile):
+                if record.rec_type == 'response':
+                    record = self.revisit_or_original(writer, record)
+                writer.write_record(record)
+
+    def revisit_or_original(self, writer, record):
+        digest = record.rec_headers.get_header('WARC-Payload-Digest')
+        if not digest:
+            return record
+        self.responses += 1
+        uri = record.rec_headers.get_header('WARC-Target-URI')
+        date = record.rec_headers.get_header('WARC-Date')
+        original = self.seen.get(digest)
+        if original is None:
+            self.seen[digest] = (uri, date)
+            return record
+        self.revisits += 1
+        return writer.create_revisit_record(
+            uri, digest, original[0], original[1],
+            http_headers=record.http_headers,
+            warc_headers_dict={'WARC-Date': date})
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(WARCIndex.CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def warc_files(path):
+    return [Path(path) / name for name in sorted(os.listdir(str(path)))
+            if name.endswith(WARC_EXTENSIONS)]
+
+
+def profile_files(path):
+    if not Path(path).is_dir():
+        return []
+    return [Path(path) / name for name in sorted(os.listdir(str(path)))
+            if name.endswith(PROFILE_EXTENSIONS)]
+
+
+# Writes a single sorted CDXJ index covering all the given WARCs, merged
+# with the lines of an earlier index if any
+def write_cdxj(index_path, warc_paths, merged_lines=()):
+    from pywb.indexer.cdxindexer import (DefaultRecordParser,
+                                         get_cdx_writer_cls)
+    options = {'cdxj': True, 'sort': True}
+    writer_cls = get_cdx_writer_cls(options)
+    parser = DefaultRecordParser(**options)
+    with open(str(index_path), 'wb') as out:
+        with writer_cls(out) as writer:
+            for path in warc_paths:
+                with open(str(path), 'rb') as infile:
+                    for entry in parser(infile):
+                        writer.write(entry, path.name)
+    if merged_lines:
+        with open(str(index_path), 'rb') as f:
+            lines = f.readlines()
+        lines.extend(merged_lines)
+        with open(str(index_path), 'wb') as f:
+            f.writelines(sorted(lines))
+
+
+# Lines of the index packed with a collection, as extracted from the RPZ
+def packed_index_lines(coll_path):
+    cluster = Path(coll_path) / 'indexes' / 'autoindex.cdx.gz'
+    if not cluster.is_file():
+        raise InvalidRPZ("The package has no ZipNum index to add to; "
+                         "record it again from scratch")
+    with gzip.open(str(cluster), 'rb') as f:
+        return [line if line.endswith(b'\n') else line + b'\n'
+                for line in f if line.strip()]
+
+
+def captured_urls(coll_path):
+    """URLs of the packed collection that replay without the live site
+    """
+    urls = set()
+    for line in packed_index_lines(coll_path):
+        cdx = json.loads(line.split(b' ', 2)[2].decode('utf-8'))
+        status = cdx.get('status', '-')
+        if cdx.get('mime') == 'warc/revisit' or status[:1] in ('2', '3'):
+            urls.add(normalize_url(cdx['url']))
+    return urls
+
+
+# Turns a sorted CDXJ index into a ZipNum cluster: blocks of lines
+# compressed as separate gzip members, a summary holding the first key of
+# each block with its offset for binary search, and the .loc file mapping
+# the cluster name to its path. Returns the files written.
+def write_zipnum(index_path, block_lines=3000):
+    index_path = Path(index_path)
+    part = index_path.stem
+    cluster_path = index_path.with_name(part + '.cdx.gz')
+    summary_path = index_path.with_name(part + '.summary')
+    loc_path = index_path.with_name(part + '.loc')
+    with open(str(index_path), 'rb') as cdx, \
+            open(str(cluster_path), 'wb') as cluster, \
+            open(str(summary_path), 'wb') as summary:
+        lineno = 0
+        while True:
+            block = list(itertools.islice(cdx, block_lines))
+            if not block:
+                break
+            data = gzip.compress(b''.join(block))
+            key = b' '.join(block[0].split(b' ', 2)[:2])
+            summary.write(b'\t'.join([
+                key, part.encode(), str(cluster.tell()).encode(),
+                str(len(data)).encode(), str(lineno).encode()]) + b'\n')
+            cluster.write(data)
+            lineno += 1
+    with open(str(loc_path), 'w') as loc:
+        loc.write('{}\t{}\n'.format(part, cluster_path.name))
+    return [cluster_path, summary_path, loc_path]
 
 
 class RPZPackWithWARC(RPZPack):
 
-    def unpack_warc(self, target, coll='warc-data'):
-        target = Path(target)
-        for name in self.tar.getnames():
-            if name[0:9] == 'WARC_DATA':
-                member = self.tar.getmember(name)
-                dest_path = target / 'collections' / coll
-                if name[10:] == 'autoindex.cdxj':
-                    dest_path = dest_path / 'indexes'
-                else:
-                    dest_path = dest_path / 'archive'
-                member.name = name[10:]
-                self.tar.extract(member, dest_path)
+    @staticmethod
+    def warc_dest(target, coll, filename):
+        dest_path = Path(target) / 'collections' / coll
+        if filename.endswith(INDEX_EXTENSIONS):
+            return dest_path / 'indexes'
+        if filename.endswith(PROFILE_EXTENSIONS):
+            return dest_path / 'profiles'
+        return dest_path / 'archive'
+
+    @classmethod
+    def unpack_warc(cls, rpz_file, target, coll='warc-data', workers=4):
+        """Extracts the WARC data of a package, seeking straight to the
+        members listed in its index
+        """
+        index = WARCIndex.read(rpz_file)
+        if index is None:
+            # packages written before the index existed
+            rpz = cls(rpz_file)
+            try:
+                rpz.unpack_members(target, coll)
+            finally:
+                rpz.close()
+            return
+        # largest first, so one big WARC doesn't start last
+        names = sorted(index, key=lambda n: index[n][1], reverse=True)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            list(pool.map(
+                lambda name: cls.extract_member(rpz_file, index, name,
+                                                target, coll), names))
+        logger.info("Extracted {} WARC data files".format(len(names)))
+
+    def unpack_members(self, target, coll):
+        for member in self.tar.getmembers():
+            if member.name[0:9] == 'WARC_DATA':
+                filename = member.name[10:]
+                member.name = filename
+                self.tar.extract(
+                    member, self.warc_dest(target, coll, filename))
+
+    @classmethod
+    def extract_member(cls, rpz_file, index, name, target, coll):
+        """Streams a member to its collection directory through a .part
+        file, checking it against the digest of the index
+        """
+        filename = name[10:]
+        dest_path = cls.warc_dest(target, coll, filename)
+        dest_path.mkdir(parents=True, exist_ok=True)
+        expected = WARCIndex.digest(index[name])
+        part = dest_path / (filename + '.part')
+        try:
+            digest = WARCIndex.extract(rpz_file, index, name, part)
+            if expected and digest != expected:
+                raise InvalidRPZ('{} is corrupt: SHA-256 {} instead of '
+                                 '{}'.format(name, digest, expected))
+        except Exception:
+            if part.exists():
+                part.unlink()
+            raise
+        os.replace(str(part), str(dest_path / filename))
+
+
+# Polls a component with exponential backoff until it is ready or its
+# deadline passes, and records how long it took
+class Readiness(object):
+    DEADLINE = 60
+    INITIAL_DELAY = 0.025
+    MAX_DELAY = 2
+    PROBE_TIMEOUT = 5
+
+    @staticmethod
+    def report(timings):
+        for component, seconds in sorted(timings.items()):
+            logger.info("{} ready in {:.3f}s".format(component, seconds))
+
+    def __init__(self, component, deadline=DEADLINE, timings=None):
+        self.component = component
+        self.deadline = deadline
+        # shared by the components of one session, see Session.readiness
+        self.timings = {} if timings is None else timings
+
+    def until(self, probe):
+        with tracer.span('ready:' + self.component) as attrs:
+            result, attrs['probes'] = self.poll(probe)
+            return result
+
+    def poll(self, probe):
+        started = time.monotonic()
+        delay = self.INITIAL_DELAY
+        attempts = 0
+        logger.info("Waiting for {} to start".format(self.component))
+        while True:
+            attempts += 1
+            try:
+                result = probe()
+            except ServiceNotReady:
+                raise
+            except (OSError, requests.RequestException) as e:
+                logger.debug("{} probe failed: {}".format(self.component, e))
+                result = None
+            elapsed = time.monotonic() - started
+            if result:
+                self.timings[self.component] = elapsed
+                logger.info("{} ready in {:.3f}s ({} probes)".format(
+                    self.component, elapsed, attempts))
+                return result, attempts
+            if elapsed >= self.deadline:
+                raise ServiceNotReady("{} failed to start within {}s".format(
+                    self.component, self.deadline))
+            time.sleep(min(delay, self.deadline - elapsed))
+            delay = min(delay * 2, self.MAX_DELAY)
+
+    def wait_for_tcp(self, host, port):
+        def probe():
+            socket.create_connection(
+                (host, port), timeout=self.PROBE_TIMEOUT).close()
+            return True
+        return self.until(probe)
+
+    def wait_for_http(self, url, accept=None):
+        """Waits until url answers with a status in accept, or any status
+        below 400 by default
+        """
+        parts = urlsplit(url)
+        port = parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+
+        # the TCP pre-check fails fast while nothing listens yet, without
+        # paying for a full HTTP exchange on every attempt
+        def probe():
+            socket.create_connection(
+                (parts.hostname, port), timeout=self.PROBE_TIMEOUT).close()
+            r = requests.get(url, timeout=self.PROBE_TIMEOUT)
+            if (r.status_code >= 400 if accept is None
+                    else r.status_code not in accept):
+                logger.debug("{} answered {}".format(
+                    self.component, r.status_code))
+                return None
+            return r
+        return self.until(probe)
+
+    def wait_for_container(self, container, log_line=None):
+        # a container that exited won't come up anymore, so there is no
+        # point waiting for the deadline
+        def exited(logs):
+            raise ServiceNotReady("{} exited before it was ready{}".format(
+                self.component,
+                ':\n' + logs.decode('utf-8', 'replace') if logs else ''))
+
+        def probe():
+            try:
+                container.reload()
+            except docker.errors.NotFound:
+                # removed as soon as it exited, logs and all
+                exited(b'')
+            state = container.attrs['State']
+            if container.status in ('exited', 'dead'):
+                exited(container.logs(tail=50))
+            if 'Health' in state:
+                return state['Health']['Status'] == 'healthy'
+            if not state['Running']:
+                return False
+            if log_line is None:
+                return True
+            return log_line in container.logs()
+        return self.until(probe)
 
 
 class SubprocessManager(object):
@@ -99,7 +598,8 @@ class SubprocessManager(object):
         self.running.append(stopable)
 
     def shutdown(self):
-        for r in self.running:
+        # in reverse, so the browser goes before the services it talks to
+        for r in reversed(self.running):
             logger.debug(r)
             try:
                 r.stop()
@@ -108,33 +608,161 @@ class SubprocessManager(object):
         logger.debug("all jobs stopped")
 
 
+# Spans timing the phases of a run, nested by the code they wrap, with
+# attributes such as sizes and the outcome of each phase. The timeline is
+# written as JSON, or in the trace event format that chrome://tracing and
+# Perfetto open. The current span is a context variable so that it follows
+# threads started with a copied context and asyncio tasks alike
+class Tracer(object):
+    current = contextvars.ContextVar('rpzdj_span', default=None)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.origin = time.monotonic()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield attrs
+            return
+        parent = self.current.get()
+        thread = threading.current_thread().name
+        try:
+            # spans of concurrent tasks would overlap on their thread
+            thread += '/' + asyncio.current_task().get_name()
+        except (RuntimeError, AttributeError):
+            pass
+        span = {'id': None, 'name': name,
+                'parent': parent['id'] if parent else None,
+                'thread': thread,
+                'start': time.monotonic() - self.origin,
+                'seconds': None, 'outcome': 'ok', 'attrs': attrs}
+        with self.lock:
+            span['id'] = len(self.spans)
+            self.spans.append(span)
+        token = self.current.set(span)
+        try:
+            yield span['attrs']
+        except SystemExit as e:
+            if e.code:
+                span['outcome'] = 'error'
+            raise
+        except BaseException as e:
+            span['outcome'] = 'error'
+            span['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            span['seconds'] = round(
+                time.monotonic() - self.origin - span['start'], 6)
+            span['start'] = round(span['start'], 6)
+            self.current.reset(token)
+
+    def totals(self):
+        """Seconds spent in each phase, summed over its spans
+        """
+        totals = collections.Counter()
+        for span in self.spans:
+            if span['seconds'] is not None:
+                totals[span['name']] += span['seconds']
+        return dict((name, round(seconds, 3))
+                    for name, seconds in totals.items())
+
+    def timeline(self):
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                         time.gmtime(self.started)),
+                'pid': os.getpid(),
+                'totals': self.totals(),
+                'spans': self.spans}
+
+    def chrome_trace(self):
+        threads = {}
+        events = []
+        for span in self.spans:
+            if span['seconds'] is None:
+                continue
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            args = dict(span['attrs'], outcome=span['outcome'])
+            if 'error' in span:
+                args['error'] = span['error']
+            events.append({'name': span['name'], 'cat': 'rpzdj', 'ph': 'X',
+                           'ts': int(span['start'] * 1e6),
+                           'dur': int(span['seconds'] * 1e6),
+                           'pid': os.getpid(), 'tid': tid, 'args': args})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path=None, chrome_path=None):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.timeline(), f, indent=2, default=str)
+            logger.info("Trace written to {}".format(path))
+        if chrome_path:
+            with open(chrome_path, 'w') as f:
+                json.dump(self.chrome_trace(), f, default=str)
+
+
+def traced(name):
+    """Runs a command in a root span and writes the trace requested with
+    --trace and --chrome-trace once it ends
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def command(args):
+            if Tracer.current.get() is not None:
+                return func(args)
+            try:
+                with tracer.span(name, pack=getattr(args, 'pack', [None])[0]):
+                    return func(args)
+            finally:
+                tracer.write(getattr(args, 'trace', None),
+                             getattr(args, 'chrome_trace', None))
+        return command
+    return decorator
+
+
+# Ports, container names and scratch space of one record or playback
+# session, so that several sessions can run side by side on a host
+class Session(object):
+
+    def __init__(self, name=None, ready_timeout=Readiness.DEADLINE):
+        self.name = name or 'rpzdj-{}'.format(uuid.uuid4().hex[:12])
+        self.ready_timeout = ready_timeout
+        self.ready_timings = {}
+        (self.site_port, self.wayback_port, self.cdp_port,
+         self.proxy_port) = free_ports(4)
+        self.pywb_name = self.name + '-pywb'
+        self.proxy_name = self.name + '-proxy'
+        self.network_name = self.name
+        self.work_dir = tempfile.mkdtemp(prefix=self.name + '_')
+
+    def profile_dir(self):
+        return tempfile.mkdtemp(prefix='chromium_', dir=self.work_dir)
+
+    def readiness(self, component):
+        return Readiness(component, self.ready_timeout, self.ready_timings)
+
+    def report_readiness(self):
+        Readiness.report(self.ready_timings)
+
+    def stop(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
 class Wayback(object):
-    PORT = 8080
 
     @staticmethod
-    def wait_for_service(port):
-        tries = 10
-        success = False
-        while (tries > 0):
-            try:
-                r = requests.get("http://localhost:{}".format(Wayback.PORT))
-                if r.status_code == 200:
-                    success = True
-                    break
-                else:
-                    raise Exception
-            except requests.RequestException:
-                tries -= 1
-                logger.info('Waiting for Wayback to start'
-                            ', {} tries left'.format(tries))
-                time.sleep(5)
-
-        if success:
-            return
-        raise Exception("Wayback failed to start correctly")
+    def wait_for_service(session):
+        session.readiness('wayback').wait_for_http(
+            "http://localhost:{}".format(session.wayback_port))
 
     @classmethod
-    def new_recorder(cls, root_dir, args):
+    def new_recorder(cls, root_dir, args, session):
         popen_args = [
             '--record',
             '--live',
@@ -143,17 +771,19 @@ class Wayback(object):
             '5',
             '-d',
             root_dir]
-        return cls(popen_args, args)
+        return cls(popen_args, session, args)
 
     @classmethod
-    def new_replayer(cls, root_dir, args=None):
+    def new_replayer(cls, root_dir, session, args=None):
         popen_args = [
             '--proxy', 'warc-data', '-d', root_dir]
-        return cls(popen_args, args)
+        return cls(popen_args, session, args)
 
-    def __init__(self, proc_args, args=None):
+    def __init__(self, proc_args, session, args=None):
         self.proc = None
         self.proc_args = proc_args
+        self.session = session
+        self.port = session.wayback_port
         self.output_args = {}
         if args and args.quiet:
             self.output_args['stdout'] = subprocess.DEVNULL
@@ -168,154 +798,904 @@ class Wayback(object):
             stop()
 
     def start(self):
+        with tracer.span('wayback_start'):
+            try:
+                proc_args = ['wayback', '-p', str(self.port)] + \
+                    self.proc_args
+                logger.debug(proc_args)
+                self.proc = subprocess.Popen(proc_args, **self.output_args)
+
+            except Exception:
+                logger.exception("Wayback service failed to start")
+                raise
+
+            Wayback.wait_for_service(self.session)
+
+
+# Keeps track of in-flight requests of a tab from its CDP events
+class NetworkTracker(object):
+    # these stay open for the life of the page and never finish loading
+    LONG_LIVED_TYPES = ('EventSource', 'WebSocket')
+
+    def __init__(self):
+        self.in_flight = set()
+        self.requests = 0
+        self.loaded = False
+        self.last_activity = time.monotonic()
+        self.profile = None
+        self.check = None
+
+    def request_will_be_sent(self, requestId, type=None, **kwargs):
+        if type in self.LONG_LIVED_TYPES:
+            return
+        if requestId not in self.in_flight:
+            self.requests += 1
+        self.in_flight.add(requestId)
+        self.last_activity = time.monotonic()
+
+    def loading_done(self, requestId, **kwargs):
+        self.in_flight.discard(requestId)
+        self.last_activity = time.monotonic()
+
+    def load_event_fired(self, **kwargs):
+        self.loaded = True
+        self.last_activity = time.monotonic()
+
+    def in_flight_count(self):
+        return len(self.in_flight)
+
+    def idle(self, idle_time):
+        return (self.loaded and not self.in_flight and
+                time.monotonic() - self.last_activity >= idle_time)
+
+    def handlers(self):
+        return {
+            'Network.requestWillBeSent': self.request_will_be_sent,
+            'Network.loadingFinished': self.loading_done,
+            'Network.loadingFailed': self.loading_done,
+            'Page.loadEventFired': self.load_event_fired
+        }
+
+
+# Timings, sizes, types and statuses of the requests of one page load,
+# collected from its CDP Network events and exported as a HAR page
+class PageProfile(object):
+
+    def __init__(self, url):
+        self.url = Crawler.RECORD_PREFIX.sub('', url)
+        self.origin = None
+        self.requests = {}
+        self.entries = []
+        self.on_content_load = self.on_load = None
+
+    def handlers(self):
+        return {
+            'Network.requestWillBeSent': self.request_will_be_sent,
+            'Network.responseReceived': self.response_received,
+            'Network.dataReceived': self.data_received,
+            'Network.loadingFinished': self.loading_finished,
+            'Network.loadingFailed': self.loading_failed,
+            'Page.domContentEventFired': self.dom_content_event_fired,
+            'Page.loadEventFired': self.load_event_fired
+        }
+
+    def request_will_be_sent(self, requestId, request, timestamp,
+                             wallTime=None, type=None,
+                             redirectResponse=None, **kwargs):
+        if self.origin is None:
+            # CDP timestamps are monotonic seconds, wallTime is epoch
+            self.origin = (wallTime or time.time(), timestamp)
+        if redirectResponse is not None and requestId in self.requests:
+            entry = self.requests.pop(requestId)
+            self.set_response(entry, redirectResponse)
+            entry['end'] = timestamp
+            self.entries.append(entry)
+        self.requests[requestId] = {
+            'request_id': requestId,
+            'url': Crawler.RECORD_PREFIX.sub('', request['url']),
+            'method': request.get('method', 'GET'),
+            'request_headers': request.get('headers', {}),
+            'type': type, 'start': timestamp, 'size': 0, 'transfer': 0}
+
+    def set_response(self, entry, response):
+        entry.update(
+            status=response.get('status', 0),
+            status_text=response.get('statusText', ''),
+            mime_type=response.get('mimeType', ''),
+            protocol=response.get('protocol', ''),
+            headers=response.get('headers', {}),
+            timing=response.get('timing'),
+            transfer=response.get('encodedDataLength', 0))
+
+    def response_received(self, requestId, response, **kwargs):
+        entry = self.requests.get(requestId)
+        if entry is not None:
+            self.set_response(entry, response)
+
+    def data_received(self, requestId, dataLength, **kwargs):
+        entry = self.requests.get(requestId)
+        if entry is not None:
+            entry['size'] += dataLength
+
+    def loading_finished(self, requestId, timestamp, encodedDataLength=0,
+                         **kwargs):
+        entry = self.requests.pop(requestId, None)
+        if entry is not None:
+            entry['end'] = timestamp
+            entry['transfer'] = encodedDataLength or entry['transfer']
+            self.entries.append(entry)
+
+    def loading_failed(self, requestId, timestamp, errorText='', **kwargs):
+        entry = self.requests.pop(requestId, None)
+        if entry is not None:
+            entry['end'] = timestamp
+            entry['error'] = errorText
+            self.entries.append(entry)
+
+    def dom_content_event_fired(self, timestamp, **kwargs):
+        self.on_content_load = timestamp
+
+    def load_event_fired(self, timestamp=None, **kwargs):
+        self.on_load = timestamp
+
+    def since_start(self, timestamp):
+        if timestamp is None or self.origin is None:
+            return -1
+        return round((timestamp - self.origin[1]) * 1000, 3)
+
+    def iso_time(self, timestamp):
+        wall = self.origin[0] + timestamp - self.origin[1]
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(wall)) + \
+            '.{:03d}Z'.format(int(wall * 1000) % 1000)
+
+    @staticmethod
+    def har_timings(entry, total):
+        timing = entry.get('timing')
+        if not timing:
+            return {'blocked': -1, 'dns': -1, 'connect': -1, 'ssl': -1,
+                    'send': 0, 'wait': 0, 'receive': total}
+
+        def span(start, end):
+            if timing.get(start, -1) < 0 or timing.get(end, -1) < 0:
+                return -1
+            return round(timing[end] - timing[start], 3)
+        starts = [timing[k] for k in ('dnsStart', 'connectStart',
+                                      'sendStart') if timing.get(k, -1) >= 0]
+        headers_end = timing.get('receiveHeadersEnd', 0)
+        # the request may have queued between being sent and requestTime
+        queued = (timing['requestTime'] - entry['start']) * 1000
+        return {
+            'blocked': round(queued + (starts[0] if starts else 0), 3),
+            'dns': span('dnsStart', 'dnsEnd'),
+            'connect': span('connectStart', 'connectEnd'),
+            'ssl': span('sslStart', 'sslEnd'),
+            'send': max(0, span('sendStart', 'sendEnd')),
+            'wait': max(0, round(headers_end - timing.get('sendEnd', 0), 3)),
+            'receive': max(0, round(total - queued - headers_end, 3))}
+
+    def har(self, page_id):
+        # requests still in flight when the page was considered loaded
+        pending = [dict(entry, end=None, error='pending')
+                   for entry in self.requests.values()]
+        entries = []
+        for entry in self.entries + pending:
+            end = entry['end'] if entry['end'] is not None else entry['start']
+            total = round((end - entry['start']) * 1000, 3)
+            har_entry = {
+                'pageref': page_id,
+                'startedDateTime': self.iso_time(entry['start']),
+                'time': total,
+                'request': {
+                    'method': entry['method'], 'url': entry['url'],
+                    'httpVersion': entry.get('protocol', ''),
+                    'headers': [{'name': k, 'value': v} for k, v in
+                                entry['request_headers'].items()],
+                    'queryString': [], 'cookies': [],
+                    'headersSize': -1, 'bodySize': -1},
+                'response': {
+                    'status': entry.get('status', 0),
+                    'statusText': entry.get('status_text', ''),
+                    'httpVersion': entry.get('protocol', ''),
+                    'headers': [{'name': k, 'value': v} for k, v in
+                                entry.get('headers', {}).items()],
+                    'cookies': [],
+                    'content': {'size': entry['size'],
+                                'mimeType': entry.get('mime_type', '')},
+                    'redirectURL': entry.get('headers', {}).get(
+                        'Location', ''),
+                    'headersSize': -1, 'bodySize': entry['transfer']},
+                'cache': {},
+                'timings': self.har_timings(entry, total),
+                '_resourceType': entry['type']}
+            if 'error' in entry:
+                har_entry['_error'] = entry['error']
+            entries.append(har_entry)
+        page = {
+            'startedDateTime': self.iso_time(self.origin[1]),
+            'id': page_id, 'title': self.url,
+            'pageTimings': {
+                'onContentLoad': self.since_start(self.on_content_load),
+                'onLoad': self.since_start(self.on_load)}}
+        return page, entries
+
+
+# Requests of a page being recorded that won't replay: leaks, which went
+# to the web directly instead of through the recorder so nothing captured
+# them, failed loads and error responses
+class CaptureCheck(object):
+    IGNORED_SCHEMES = ('data', 'blob', 'about', 'chrome', 'chrome-extension',
+                       'devtools')
+    IGNORED_ERRORS = ('net::ERR_ABORTED',)
+
+    def __init__(self, page_url, recorder_prefix):
+        self.page = Crawler.RECORD_PREFIX.sub('', page_url)
+        self.recorder_prefix = recorder_prefix
+        self.requests = {}
+        self.issues = collections.OrderedDict()
+
+    def handlers(self):
+        return {
+            'Network.requestWillBeSent': self.request_will_be_sent,
+            'Network.webSocketCreated': self.web_socket_created,
+            'Network.responseReceived': self.response_received,
+            'Network.loadingFailed': self.loading_failed
+        }
+
+    def add(self, kind, url, **details):
+        if urlsplit(url).scheme in self.IGNORED_SCHEMES:
+            return
+        key = (kind, Crawler.RECORD_PREFIX.sub('', url))
+        if key not in self.issues:
+            self.issues[key] = dict(details, kind=kind, url=key[1],
+                                    page=self.page)
+
+    def request_will_be_sent(self, requestId, request, type=None,
+                             **kwargs):
+        url = request['url']
+        self.requests[requestId] = (url, type)
+        if not url.startswith(self.recorder_prefix):
+            self.add('leak', url, type=type)
+
+    def web_socket_created(self, requestId, url, **kwargs):
+        if not url.startswith(self.recorder_prefix.replace('http', 'ws',
+                                                           1)):
+            self.add('leak', url, type='WebSocket')
+
+    def response_received(self, requestId, response, type=None, **kwargs):
+        status = response.get('status', 0)
+        if status >= 400 and response['url'].startswith(
+                self.recorder_prefix):
+            self.add('status', response['url'], type=type, status=status)
+
+    def loading_failed(self, requestId, errorText='', canceled=False,
+                       type=None, **kwargs):
+        url, type = self.requests.get(requestId, (None, type))
+        if url is None or canceled or errorText in self.IGNORED_ERRORS:
+            return
+        self.add('failed', url, type=type, error=errorText)
+
+    def requeue_urls(self):
+        """URLs worth recording on their own: leaks and loads that failed
+        or errored on the server, but not client errors such as 404s
+        """
+        urls = []
+        for issue in self.issues.values():
+            if issue['kind'] == 'status' and issue['status'] < 500:
+                continue
+            if urlsplit(issue['url']).scheme in ('http', 'https') and \
+                    issue['url'] != self.page:
+                urls.append(issue['url'])
+        return urls
+
+
+# A single websocket to the browser carrying the commands and events of
+# every tab, each attached as a flattened session
+class CDPConnection(object):
+    TIMEOUT = 30
+
+    @classmethod
+    async def open(cls, ws_url):
+        import websockets
+        ws = await websockets.connect(ws_url, max_size=None,
+                                      ping_interval=None)
+        return cls(ws)
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.message_ids = itertools.count(1)
+        self.pending = {}
+        self.sessions = {}
+        self.closed = False
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def send(self, method, params=None, session_id=None,
+                   timeout=None):
+        if self.closed:
+            raise CDPError("{}: connection closed".format(method))
+        message_id = next(self.message_ids)
+        message = {'id': message_id, 'method': method,
+                   'params': params or {}}
+        if session_id:
+            message['sessionId'] = session_id
+        reply = asyncio.get_event_loop().create_future()
+        self.pending[message_id] = reply
         try:
-            proc_args = ['wayback', '-p', str(Wayback.PORT)] + self.proc_args
-            logger.debug(proc_args)
-            self.proc = subprocess.Popen(proc_args, **self.output_args)
+            await self.ws.send(json.dumps(message))
+            reply = await asyncio.wait_for(reply, timeout or self.TIMEOUT)
+        finally:
+            self.pending.pop(message_id, None)
+        if 'error' in reply:
+            raise CDPError("{}: {}".format(
+                method, reply['error'].get('message')))
+        return reply.get('result', {})
 
-        except Exception:
-            logger.exception("Wayback service failed to start")
-            raise
+    def events(self, session_id):
+        return self.sessions.setdefault(session_id, asyncio.Queue())
+
+    def forget(self, session_id):
+        self.sessions.pop(session_id, None)
 
-        Wayback.wait_for_service(Wayback.PORT)
+    async def read(self):
+        try:
+            while True:
+                message = json.loads(await self.ws.recv())
+                if 'id' in message:
+                    reply = self.pending.get(message['id'])
+                    if reply is not None and not reply.done():
+                        reply.set_result(message)
+                    continue
+                events = self.sessions.get(message.get('sessionId'))
+                if events is not None:
+                    events.put_nowait((message['method'],
+                                       message.get('params', {})))
+        except Exception as e:
+            if not self.closed:
+                logger.debug("CDP connection lost: {}".format(e))
+        finally:
+            self.closed = True
+            for reply in self.pending.values():
+                if not reply.done():
+                    reply.set_exception(CDPError("connection closed"))
+            for events in self.sessions.values():
+                events.put_nowait(None)
+
+    async def close(self):
+        self.closed = True
+        await self.ws.close()
+        self.reader.cancel()
+
+
+# One page target of the browser and the stream of its events
+class CDPTab(object):
+
+    def __init__(self, connection, target_id, session_id):
+        self.connection = connection
+        self.target_id = target_id
+        self.session_id = session_id
+        self.events = connection.events(session_id)
+
+    async def send(self, method, params=None, timeout=None):
+        return await self.connection.send(method, params, self.session_id,
+                                          timeout)
+
+    # Next (method, params) event, or None when none came in time
+    async def next_event(self, timeout):
+        try:
+            event = await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if event is None:
+            raise CDPError("connection closed")
+        return event
 
+    def drain(self):
+        while not self.events.empty():
+            self.events.get_nowait()
 
-# Runs Chromium and drives it via CDP
+
+# Runs Chromium and drives it via CDP, from an event loop on a thread of
+# its own so that the synchronous callers can hand it coroutines
 class Driver(object):
 
     CHROMIUM_REVISION = 610995
-    CDP_PORT = 9222
     PYWB_HOST = PROXY_HOST = 'localhost'
-    PROXY_PORT = 8081
+    IDLE_TIME = 2
+    MAX_WAIT = 120
+    LINKS_SCRIPT = 'Array.from(document.links, function(a) { return a.href; })'
+
+    HEADLESS_FLAGS = ['--headless', '--disable-gpu', '--hide-scrollbars',
+                      '--mute-audio']
 
     @classmethod
-    def new_recording_driver(cls, coll_name):
-        return cls('record', coll_name)
+    def new_recording_driver(cls, coll_name, session, headless=False,
+                             browser_url=None, profile=False):
+        return cls('record', session, coll_name, headless, browser_url,
+                   profile)
 
     @classmethod
-    def new_replay_driver(cls):
-        return cls('replay')
+    def new_replay_driver(cls, session):
+        return cls('replay', session)
 
-    def __init__(self, mode, coll_name=None):
+    def __init__(self, mode, session, coll_name=None, headless=False,
+                 browser_url=None, profile=False):
         self.mode = mode
+        self.session = session
         if coll_name:
             self.coll_name = coll_name
-        self.chromium_executable = None
-        os.environ['PYPPETEER_CHROMIUM_REVISION'] = str(self.CHROMIUM_REVISION)
-        from pyppeteer import chromium_downloader
-        self.chromium_downloader = chromium_downloader
+        self.cdp_port = session.cdp_port
+        self.wayback_port = session.wayback_port
+        # with a browser_url the driver works in a browser context of an
+        # already running Chromium instead of starting its own
+        self.browser_url = browser_url
+        self.context_id = None
+        self.profiles = [] if profile else None
+        self.checks = [] if mode == 'record' else None
+        self.cdp = None
+        self.loop = None
+        self.profile_dir = None
         self.proc = None
-        self.chromium_executable = \
-            self.chromium_downloader.chromium_executable()
-        logger.info(self.chromium_executable)
-        self.flags = []
+        self.chromium_executable = None
+        if not browser_url:
+            os.environ['PYPPETEER_CHROMIUM_REVISION'] = \
+                str(self.CHROMIUM_REVISION)
+            from pyppeteer import chromium_downloader
+            self.chromium_downloader = chromium_downloader
+            self.chromium_executable = \
+                self.chromium_downloader.chromium_executable()
+            logger.info(self.chromium_executable)
+        self.flags = list(self.HEADLESS_FLAGS) if headless else []
         if self.mode == 'replay':
-            self.flags = [
+            self.flags += [
                 '--proxy-server=http={}:{};https={}:{}'.format(
                     self.PROXY_HOST,
-                    self.PROXY_PORT,
+                    self.session.proxy_port,
                     self.PROXY_HOST,
-                    Wayback.PORT),
+                    self.wayback_port),
                 '--ignore-certificate-errors',
                 '--disk-cache-dir=/dev/null',
                 '--disk-cache-size=1'
             ]
-        elif self.mode == 'record':
-            self.flags = [
+        elif self.mode in ('record', 'bench'):
+            self.flags += [
                 '--disk-cache-dir=/dev/null',
                 '--disk-cache-size=1'
             ]
 
     def start(self):
+        with tracer.span('browser_start', shared=bool(self.browser_url)):
+            if not self.browser_url:
+                self.launch()
+            res = self.session.readiness('chromium').wait_for_http(
+                self.cdp_url() + '/json/version')
+            self.browser_ws_url = res.json()['webSocketDebuggerUrl']
+
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever,
+                             daemon=True).start()
+            self.cdp = self.run(CDPConnection.open(self.browser_ws_url))
+            if self.browser_url:
+                self.context_id = self.run(self.cdp.send(
+                    'Target.createBrowserContext'))['browserContextId']
+                logger.info("Using browser context {} of {}".format(
+                    self.context_id, self.cdp_url()))
+            else:
+                logger.info("Chromium is fired up and ready to go!")
+
+    def launch(self):
         if not self.chromium_executable.exists():
             logger.info("Downloading Chromium browser")
             self.chromium_downloader.download_chromium()
 
         logger.info("Chrome Executable: {}".format(self.chromium_executable))
 
+        # a Chromium started on a profile already in use hands its URLs to
+        # the running instance and exits, so each driver gets its own
+        self.profile_dir = self.session.profile_dir()
         self.proc = subprocess.Popen([
             self.chromium_executable,
-            '--remote-debugging-port={}'.format(self.CDP_PORT),
+            '--remote-debugging-port={}'.format(self.cdp_port),
+            '--user-data-dir={}'.format(self.profile_dir),
             '--disable-notifications',
             '--disable-infobars',
             '--disable-breakpad',
             *self.flags
         ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        tries = 5
-        res = None
-        while tries > 0:
-            try:
-                res = requests.get(self.cdp_url() + '/json/version')
-                break
-            except requests.RequestException:
-                time.sleep(5)
-                tries -= 1
-                logger.info("Waiting for browser to respond on port 9222")
-
-        if res and res.status_code != 200:
-            raise Exception("Bad status code from Chrome: "
-                            "{}".format(res.status_code))
-
-        self.browser_ws_url = res.json()['webSocketDebuggerUrl']
-        self.browser = pychrome.Browser(url=self.cdp_url())
-        self.tab_zero = self.browser.list_tab()[0]
-        logger.info("Chromium is fired up and ready to go!")
+    @staticmethod
+    async def in_span(span, coro):
+        # the loop thread has a context of its own
+        Tracer.current.set(span)
+        return await coro
+
+    def run(self, coro, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(
+            self.in_span(Tracer.current.get(), coro), self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # timed out or interrupted: don't leave the coroutine running
+            future.cancel()
+            raise
 
     def cdp_url(self):
-        return "http://localhost:{}".format(self.CDP_PORT)
+        if self.browser_url:
+            return self.browser_url.rstrip('/')
+        return "http://localhost:{}".format(self.cdp_port)
 
     def stop(self):
-        for t in self.browser.list_tab():
-            try:
-                t.stop()
-            except pychrome.exceptions.RuntimeException:
-                pass
-        message = {
-            'id': 9999,
-            'method': 'Browser.close'
-        }
-        json_message = json.dumps(message)
-        ws = websocket.create_connection(self.browser_ws_url)
-        ws.send(json_message)
-        time.sleep(1)
-        ws.close()
-        if self.proc:
+        if self.cdp is not None:
+            self.run(self.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        elif self.proc:
             self.proc.terminate()
+        if self.proc:
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
 
-    def replay(self, url_to_visit):
-        tab = self.browser.new_tab()
-        tab.start()
-        tab.call_method("Network.enable")
-        tab.call_method("Page.navigate", url=url_to_visit)
+    async def close(self):
+        try:
+            if self.context_id:
+                # closes the context's tabs but leaves the shared browser up
+                await self.cdp.send('Target.disposeBrowserContext',
+                                    {'browserContextId': self.context_id})
+                self.context_id = None
+            else:
+                await self.cdp.send('Browser.close', timeout=5)
+        except (CDPError, asyncio.TimeoutError):
+            pass
+        await self.cdp.close()
 
-    def record(self, url_to_visit, keep_open=False):
-        logger.info("Recording {}".format(url_to_visit))
-        record_url = "http://{}:{}/{}/record/{}".format(
+    def replay(self, url_to_visit):
+        return self.run(self.open_page(url_to_visit))
+
+    async def open_page(self, url):
+        # the tab is handed to the user: nothing reads its events, so
+        # they are neither enabled nor queued
+        tab = await self.open_tab()
+        self.cdp.forget(tab.session_id)
+        await tab.send("Page.navigate", {'url': url})
+        return tab
+
+    def record_url(self, url_to_visit, modifier=''):
+        if modifier:
+            modifier += '/'
+        return "http://{}:{}/{}/record/{}{}".format(
             self.PYWB_HOST,
-            Wayback.PORT,
+            self.wayback_port,
             self.coll_name,
+            modifier,
             url_to_visit)
-        tab = self.browser.new_tab()
-        tab.start()
-        seconds_since_something_happened = [0]
-
-        def reset_secs(**args):
-            seconds_since_something_happened[0] = 0
-        tab.set_listener("Network.loadingFinished", reset_secs)
-        tab.call_method("Page.navigate", url=record_url)
-        while seconds_since_something_happened[0] < 20:
-            logger.info("Waiting for resources to load in browser")
-            tab.wait(1)
-            seconds_since_something_happened[0] += 1
+
+    async def open_tab(self):
+        params = {'url': 'about:blank'}
+        if self.context_id:
+            params['browserContextId'] = self.context_id
+        target_id = (await self.cdp.send(
+            'Target.createTarget', params))['targetId']
+        session_id = (await self.cdp.send(
+            'Target.attachToTarget',
+            {'targetId': target_id, 'flatten': True}))['sessionId']
+        return CDPTab(self.cdp, target_id, session_id)
+
+    async def close_tab(self, tab):
+        self.cdp.forget(tab.session_id)
+        await self.cdp.send('Target.closeTarget',
+                            {'targetId': tab.target_id})
+
+    async def load(self, tab, url, idle_time=None, max_wait=None):
+        if idle_time is None:
+            idle_time = self.IDLE_TIME
+        if max_wait is None:
+            max_wait = self.MAX_WAIT
+        tracker = NetworkTracker()
+        listeners = [tracker.handlers()]
+        if self.checks is not None:
+            tracker.check = CaptureCheck(url, 'http://{}:{}/'.format(
+                self.PYWB_HOST, self.wayback_port))
+            self.checks.append(tracker.check)
+            listeners.append(tracker.check.handlers())
+        if self.profiles is not None:
+            tracker.profile = PageProfile(url)
+            self.profiles.append(tracker.profile)
+            listeners.append(tracker.profile.handlers())
+        with tracer.span('load_page', url=url) as attrs:
+            tab.drain()
+            await tab.send("Network.enable")
+            await tab.send("Page.enable")
+            await tab.send("Page.navigate", {'url': url})
+            started = time.monotonic()
+            while not tracker.idle(idle_time):
+                if time.monotonic() - started >= max_wait:
+                    logger.warning("Network still busy after {}s, {} "
+                                   "requests in flight".format(
+                                       max_wait, tracker.in_flight_count()))
+                    break
+                event = await tab.next_event(0.1)
+                if event is None:
+                    continue
+                for handlers in listeners:
+                    if event[0] in handlers:
+                        handlers[event[0]](**event[1])
+            attrs['requests'] = tracker.requests
+            attrs['timed_out'] = not tracker.idle(0)
+        return tracker
+
+    def write_profile(self, directory):
+        """Writes the requests of every page loaded as a HAR file in
+        directory and returns its path
+        """
+        pages = []
+        entries = []
+        for i, profile in enumerate(p for p in self.profiles if p.origin):
+            page, page_entries = profile.har('page_{}'.format(i + 1))
+            pages.append(page)
+            entries.extend(page_entries)
+        heaviest = sorted(entries, key=lambda e: -e['response']['bodySize'])
+        for entry in heaviest[:5]:
+            logger.info("{:>9.1f} KB {:>8.0f} ms  {}".format(
+                entry['response']['bodySize'] / 1e3, entry['time'],
+                entry['request']['url']))
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / 'profile-{}.har'.format(
+            time.strftime('%Y%m%d%H%M%S'))
+        with open(str(path), 'w') as f:
+            json.dump({'log': {
+                'version': '1.2',
+                'creator': {'name': 'reprozip-web', 'version': '0.1'},
+                'pages': pages,
+                'entries': entries}}, f)
+        logger.info("Wrote profile of {} requests on {} pages to {}".format(
+            len(entries), len(pages), path))
+        return path
+
+    def write_misses(self, directory, requeued=()):
+        """Writes the leaks, failed loads and error responses seen while
+        recording as a JSON report in directory and returns it
+        """
+        issues = {'leak': [], 'failed': [], 'status': []}
+        for check in self.checks:
+            for issue in check.issues.values():
+                issues[issue['kind']].append(issue)
+        report = {
+            'pages': len(self.checks),
+            'leaks': issues['leak'],
+            'failed': issues['failed'],
+            'errors': issues['status'],
+            'requeued': sorted(requeued)
+        }
+        for issue in issues['leak'][:5]:
+            logger.warning("Leaked to the live web: {} (from {})".format(
+                issue['url'], issue['page']))
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / 'misses-{}.json'.format(
+            time.strftime('%Y%m%d%H%M%S'))
+        with open(str(path), 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("{} leaks, {} failed loads and {} error responses "
+                    "while recording, see {}".format(
+                        len(report['leaks']), len(report['failed']),
+                        len(report['errors']), path))
+        return report
+
+    async def links(self, tab):
+        res = await tab.send("Runtime.evaluate",
+                             {'expression': self.LINKS_SCRIPT,
+                              'returnByValue': True})
+        return res.get('result', {}).get('value') or []
+
+    def record(self, url_to_visit, keep_open=False, idle_time=None,
+               max_wait=None):
+        return self.run(self.record_page(url_to_visit, keep_open,
+                                         idle_time, max_wait))
+
+    async def record_page(self, url_to_visit, keep_open=False,
+                          idle_time=None, max_wait=None):
+        logger.info("Recording {}".format(url_to_visit))
+        tab = await self.open_tab()
+        started = time.monotonic()
+        logger.info("Waiting for resources to load in browser")
+        tracker = await self.load(tab, self.record_url(url_to_visit),
+                                  idle_time, max_wait)
+        logger.info("Page settled after {:.1f}s ({} requests)".format(
+            time.monotonic() - started, tracker.requests))
         if keep_open:
             return 0
-        tab.stop()
-        self.browser.close_tab(tab)
+        await self.close_tab(tab)
         return 0
 
 
+def normalize_url(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(parts.port)
+    query = '&'.join(sorted(q for q in parts.query.split('&') if q))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+# URLs waiting to be recorded, each admitted once after normalization.
+# Used from the tasks of a single event loop, so it needs no locking
+class Frontier(object):
+
+    def __init__(self, max_pages, max_depth, known=()):
+        self.changed = asyncio.Event()
+        self.queue = collections.deque()
+        self.known = set(known)
+        self.seen = set()
+        self.pending = 0
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+
+    def add(self, url, depth):
+        url = normalize_url(url)
+        if (url in self.seen or url in self.known or
+                depth > self.max_depth or
+                len(self.seen) >= self.max_pages):
+            return False
+        self.seen.add(url)
+        self.queue.append((url, depth))
+        self.changed.set()
+        return True
+
+    # Returns None once the queue is empty and no page in progress can
+    # add to it anymore
+    async def get(self):
+        while not self.queue and self.pending:
+            self.changed.clear()
+            await self.changed.wait()
+        if not self.queue:
+            return None
+        self.pending += 1
+        return self.queue.popleft()
+
+    def done(self):
+        self.pending -= 1
+        self.changed.set()
+
+
+# Records a site by following its same-origin links from a set of seeds,
+# with one browser tab per worker task
+class Crawler(object):
+    # pywb's URL prefix for recorded pages, e.g.
+    # http://localhost:8080/warc-data/record/mp_/http://site/
+    RECORD_PREFIX = re.compile(
+        r'^https?://[^/]+/[^/]+/record/(\d*[a-z]{2}_/)?')
+
+    def __init__(self, driver, site_url, tabs=4, max_depth=2,
+                 max_pages=100, idle_time=None, max_wait=None,
+                 known=(), requeue_misses=False):
+        self.driver = driver
+        # leaked and failed requests are recorded again as pages of their
+        # own, without following their links
+        self.requeue_misses = requeue_misses
+        self.requeued = set()
+        # already recorded pages are neither visited nor crawled through
+        self.known = known
+        self.origin = urlsplit(normalize_url(site_url))[:2]
+        self.tabs = tabs
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.frontier = None
+        self.idle_time = idle_time
+        self.max_wait = max_wait
+        self.pages = []
+
+    def original_url(self, url):
+        return self.RECORD_PREFIX.sub('', url)
+
+    def same_origin(self, url):
+        return urlsplit(normalize_url(url))[:2] == self.origin
+
+    async def visit(self, tab, url, depth):
+        started = time.monotonic()
+        page = {'url': url, 'depth': depth}
+        try:
+            tracker = await self.driver.load(
+                tab, self.driver.record_url(url, 'mp_'),
+                self.idle_time, self.max_wait)
+            page['requests'] = tracker.requests
+            page['timed_out'] = not tracker.idle(0)
+            links = [self.original_url(link)
+                     for link in await self.driver.links(tab)]
+            page['links'] = sum(
+                self.frontier.add(link, depth + 1)
+                for link in links if self.same_origin(link))
+            if self.requeue_misses and tracker.check is not None:
+                misses = [u for u in tracker.check.requeue_urls()
+                          if self.frontier.add(u, self.max_depth)]
+                self.requeued.update(misses)
+                page['requeued'] = len(misses)
+        except Exception as e:
+            logger.warning("Failed to record {}: {}".format(url, e))
+            page['error'] = str(e)
+        page['seconds'] = round(time.monotonic() - started, 3)
+        logger.info("Recorded {} in {:.1f}s".format(url, page['seconds']))
+        self.pages.append(page)
+
+    async def worker(self):
+        tab = await self.driver.open_tab()
+        try:
+            while True:
+                item = await self.frontier.get()
+                if item is None:
+                    break
+                try:
+                    await self.visit(tab, *item)
+                finally:
+                    self.frontier.done()
+        finally:
+            await self.driver.close_tab(tab)
+
+    async def crawl(self, seeds, extra=()):
+        self.frontier = Frontier(self.max_pages, self.max_depth, self.known)
+        for seed in seeds:
+            if self.same_origin(seed):
+                self.frontier.add(seed, 0)
+            else:
+                logger.warning("Skipping off-site seed {}".format(seed))
+        # resources of any origin to record without following their links
+        for url in extra:
+            self.frontier.add(url, self.max_depth)
+        await asyncio.gather(*[self.worker() for _ in range(self.tabs)])
+
+    def run(self, seeds, extra=()):
+        started = time.monotonic()
+        self.driver.run(self.crawl(seeds, extra))
+        return self.report(time.monotonic() - started)
+
+    def report(self, seconds):
+        timings = sorted(p['seconds'] for p in self.pages)
+        report = {
+            'pages': len(self.pages),
+            'failed': sum(1 for p in self.pages if 'error' in p),
+            'seconds': round(seconds, 3),
+            'page_seconds_mean': (round(sum(timings) / len(timings), 3)
+                                  if timings else 0),
+            'page_seconds_max': timings[-1] if timings else 0,
+            'per_page': sorted(self.pages, key=lambda p: -p['seconds'])
+        }
+        logger.info("Crawled {} pages in {:.1f}s ({} failed, mean {}s, "
+                    "max {}s per page)".format(
+                        report['pages'], report['seconds'],
+                        report['failed'], report['page_seconds_mean'],
+                        report['page_seconds_max']))
+        return report
+
+
+def read_seeds(site_url, seed_file=None, sitemap=None):
+    seeds = [site_url]
+    if seed_file:
+        with open(seed_file) as f:
+            seeds.extend(urljoin(site_url, line.strip()) for line in f
+                         if line.strip() and not line.startswith('#'))
+    if sitemap:
+        r = requests.get(urljoin(site_url, sitemap))
+        r.raise_for_status()
+        tree = ElementTree.fromstring(r.content)
+        seeds.extend(urljoin(site_url, loc.text.strip())
+                     for loc in tree.iter()
+                     if loc.tag.endswith('loc') and loc.text)
+    return seeds
+
+
+def read_not_found(site_url, bench_report=None):
+    """URLs a `reprounzip dj bench` report found missing from the archive
+    """
+    if not bench_report:
+        return []
+    with open(bench_report) as f:
+        report = json.load(f)
+    return [urljoin(site_url, url) for url in report.get('not_found_urls',
+                                                         [])]
+
+
 subprocess_manager = SubprocessManager()
+tracer = Tracer()
 
 
 def shutdown(sig, frame):
@@ -330,9 +1710,12 @@ def register(stopable):
 def find_container(target):
     unpacked_info = read_dict(target)
     image_name = unpacked_info['current_image'].decode()
+    # images from the image cache come with their tag, built ones without
+    if ':' not in image_name.rsplit('/', 1)[-1]:
+        image_name += ':latest'
     client = docker.from_env()
     return list(c for c in client.containers.list()
-                if c.image.tags.count("{}:latest".format(image_name)))[0]
+                if c.image.tags.count(image_name))[0]
 
 
 def resource_path(project_path):
@@ -346,12 +1729,20 @@ def resource_path(project_path):
 def cleanup(args):
     if args.skip_destroy or args.skip_run:
         return
+    with tracer.span('cleanup'):
+        remove_site(args)
+
+
+def remove_site(args):
     target = Path(args.target[0])
     container = find_container(target)
     image = container.image
     container.stop()
     container.remove()
-    if not args.skip_setup:
+    if not args.skip_setup and getattr(args, 'reuse_image', False):
+        # the image stays in the cache for the next run of this package
+        shutil.rmtree(str(target))
+    elif not args.skip_setup:
         client = docker.from_env()
         try:
             client.images.remove(image.id)
@@ -365,31 +1756,13 @@ def cleanup(args):
 
 
 
-def wait_for_site(url):
+def wait_for_site(url, session):
     logger.debug(url)
-    tries = 20
-    success = False
-    while tries > 0:
-        try:
-            r = requests.get(url)
-            if r.status_code != 200:
-                logger.debug(r.status_code)
-            r.raise_for_status()
-            success = True
-            break
-        except requests.RequestException:
-            tries -= 1
-            logger.info("Waiting for site to start, {} tries "
-                        "left".format(tries))
-            time.sleep(5)
-
-    if success:
-        logger.info("Site successfully responded")
-    else:
-        raise TimeoutError("No response from target site")
+    session.readiness('site').wait_for_http(url)
+    logger.info("Site successfully responded")
 
 
-def run_site(args):
+def run_site(args, session):
     if hasattr(args, 'pack'):
         rpz_path = Path(args.pack[0])
         if not rpz_path.exists():
@@ -412,20 +1785,41 @@ def run_site(args):
     args.__setattr__('docker_option', [])
 
     if not args.skip_setup:
-        docker_setup(args)
-        rpz = RPZPackWithWARC(args.pack[0])
-        rpz.unpack_warc(target)
+        # the WARC data is extracted while the image builds, next to the
+        # target since docker_setup insists on creating it
+        staging = Path(tempfile.mkdtemp(prefix='.rpzdj_warc_',
+                                        dir=str(target.absolute().parent)))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1) as pool:
+                extraction = pool.submit(contextvars.copy_context().run,
+                                         extract_warc_data, args.pack[0],
+                                         staging)
+                with tracer.span('docker_setup') as attrs:
+                    attrs['cached'] = getattr(args, 'reuse_image', False)
+                    if attrs['cached']:
+                        image_cache = ImageCache(
+                            budget=args.image_cache_size)
+                        image_cache.setup(args)
+                    else:
+                        docker_setup(args)
+                extraction.result()
+            if (staging / 'collections').is_dir():
+                (staging / 'collections').rename(target / 'collections')
+        finally:
+            shutil.rmtree(str(staging))
 
+    host_port = getattr(args, 'host_port', None) or args.port
     if not args.skip_run:
         args.__setattr__('detach', True)
-        args.__setattr__('expose_port', ['{}:{}'.format(args.port, args.port)])
+        args.__setattr__('expose_port', ['{}:{}'.format(host_port, args.port)])
         args.__setattr__('x11', None)
         args.__setattr__('cmdline', None)
         args.__setattr__('run', None)
         args.__setattr__('x11_display', None)
         args.__setattr__('pass_env', None)
         args.__setattr__('set_env', None)
-        docker_run(args)
+        with tracer.span('docker_run'):
+            docker_run(args)
 
     if not Path(target / 'collections').is_dir():
         subprocess.Popen(['wb-manager', 'init',
@@ -434,43 +1828,106 @@ def run_site(args):
     if hasattr(args, 'url'):
         url = args.url[0]
     else:
-        url = "http://localhost:{}".format(args.port)
-    wait_for_site(url)
+        url = "http://localhost:{}".format(host_port)
+    wait_for_site(url, session)
     return url
 
 
+def extract_warc_data(rpz_file, target):
+    with tracer.span('extract_warc') as attrs:
+        RPZPackWithWARC.unpack_warc(rpz_file, target)
+        attrs['bytes'] = sum(path.stat().st_size
+                             for path in Path(target).rglob('*')
+                             if path.is_file())
+
+
 def pack_it(args):
-    try:
+    # live-record has no package to add the WARC data to
+    if getattr(args, 'pack', None) is None:
+        return
+    with tracer.span('pack'):
         packer = WARCPacker(Path(args.pack[0]))
-        packer.add_warc_data(args.target[0])
+        try:
+            packer.add_warc_data(args.target[0], incremental=getattr(
+                args, 'incremental', False))
+        except BaseException:
+            packer.abort()
+            raise
         packer.close()
-    except AttributeError:
-        pass
 
 
+@traced('record')
 def record(args):
-    WARCPacker.no_second_pass(args.pack[0])
+    incremental = getattr(args, 'incremental', False)
+    if not incremental and getattr(args, 'pack', None) is not None:
+        WARCPacker.no_second_pass(args.pack[0])
     if args.skip_record:
         pack_it(args)
         return
     if args.quiet:
         logger.setLevel(30)
+    session = getattr(args, 'session', None) or \
+        Session(ready_timeout=args.ready_timeout)
+    register(session)
+    summary = {'pages': 1}
     try:
-        url = run_site(args)
+        url = run_site(args, session)
         signal.signal(signal.SIGINT, shutdown)
 
         logger.info("Start recording")
-        recorder = Wayback.new_recorder(args.target[0], args)
+        recorder = Wayback.new_recorder(args.target[0], args, session)
         recorder.start()
         register(recorder)
 
         logger.info("Start browser")
-        driver = Driver.new_recording_driver('warc-data')
+        driver = Driver.new_recording_driver(
+            'warc-data', session, args.headless, args.browser, args.profile)
         driver.start()
         register(driver)
 
-        driver.record(url, args.keep_browser)
-        time.sleep(5)  # ensure wayback finishes writing warc
+        session.report_readiness()
+        requeue = getattr(args, 'requeue_misses', False)
+        if args.crawl or incremental or requeue:
+            known, missing = (), ()
+            if incremental:
+                known = captured_urls(
+                    Path(args.target[0]) / 'collections' / 'warc-data')
+                missing = read_not_found(url, args.from_bench)
+                logger.info("{} URLs already recorded, {} reported "
+                            "missing".format(len(known), len(missing)))
+            crawler = Crawler(driver, url, args.tabs,
+                              args.max_depth if args.crawl else 0,
+                              args.max_pages, args.idle_time, args.max_wait,
+                              known, requeue)
+            with tracer.span('crawl') as attrs:
+                report = crawler.run(read_seeds(url, args.seeds,
+                                                args.sitemap), missing)
+                attrs['pages'] = report['pages']
+            summary = {'pages': report['pages'], 'failed': report['failed']}
+            requeued = crawler.requeued
+            if args.keep_browser:
+                # the crawl closed its tabs, leave one to go on by hand
+                driver.run(driver.open_page(driver.record_url(url)))
+            if args.crawl_report:
+                with open(args.crawl_report, 'w') as f:
+                    json.dump(report, f, indent=2)
+        else:
+            driver.record(url, args.keep_browser, args.idle_time,
+                          args.max_wait)
+            requeued = ()
+        with tracer.span('warc_flush_wait'):
+            time.sleep(5)  # ensure wayback finishes writing warc
+        misses = driver.write_misses(
+            Path(args.target[0]) / 'collections' / 'warc-data' / 'profiles',
+            requeued)
+        summary.update(leaks=len(misses['leaks']),
+                       failed_loads=len(misses['failed']),
+                       error_responses=len(misses['errors']))
+        if driver.profiles:
+            with tracer.span('write_profile'):
+                driver.write_profile(
+                    Path(args.target[0]) / 'collections' / 'warc-data' /
+                    'profiles')
 
         if args.keep_browser:
             input("Press Enter to stop recording and quit")
@@ -482,6 +1939,7 @@ def record(args):
 
     pack_it(args)
     cleanup(args)
+    return summary
 
 
 def live_record(args):
@@ -494,6 +1952,250 @@ def live_record(args):
     record(args)
 
 
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def batch_packs(specs, default_port):
+    """(pack, port) for each RPZ file or directory of RPZ files, where a
+    pack may be given as <pack>:<port>
+    """
+    for spec in specs:
+        path, sep, port = spec.rpartition(':')
+        if not (sep and port.isdigit()):
+            path, port = spec, default_port
+        if os.path.isdir(path):
+            for pack in sorted(glob.glob(os.path.join(path, '*.rpz'))):
+                yield pack, port
+        else:
+            yield path, port
+
+
+def warc_size(rpz_file):
+    index = WARCIndex.read(rpz_file) or {}
+    return sum(entry[1] for name, entry in index.items()
+               if name.endswith(WARC_EXTENSIONS))
+
+
+def batch_job(args, log_file, conn):
+    # runs in its own process, so the job gets its own subprocess manager
+    # and signal handler; ports are picked here, right before they are used
+    global subprocess_manager, tracer
+    # the shared browser of the parent is not the job's to stop
+    subprocess_manager = SubprocessManager()
+    tracer = Tracer()
+    logger.handlers = [logging.FileHandler(log_file)]
+    # the site stays on --port of the host, as its URLs end up in the WARC
+    args.session = Session(ready_timeout=args.ready_timeout)
+    result = {'pack': args.pack[0], 'target': args.target[0],
+              'log': log_file}
+    started = time.monotonic()
+    try:
+        result.update(record(args) or {})
+        result['status'] = 'ok'
+    except BaseException as e:
+        logger.exception("Recording {} failed".format(args.pack[0]))
+        result['status'] = 'failed'
+        result['error'] = str(e) or type(e).__name__
+        try:
+            cleanup(args)
+        except Exception:
+            pass
+    result['seconds'] = round(time.monotonic() - started, 3)
+    result['phases'] = tracer.totals()
+    try:
+        result['warc_bytes'] = warc_size(args.pack[0])
+    except OSError:
+        result['warc_bytes'] = 0
+    conn.send(result)
+    conn.close()
+
+
+# Starts batch jobs in their own processes, no more than `jobs` at a time
+# and only while the host has the memory and CPU left for another one
+class BatchScheduler(object):
+    POLL = 5
+
+    def __init__(self, jobs, job_memory, max_load):
+        self.jobs = jobs
+        self.job_memory = job_memory * 1e9
+        self.max_load = max_load
+
+    def can_start(self, running):
+        if running >= self.jobs:
+            return False
+        if running == 0:
+            return True
+        memory = available_memory()
+        if memory is not None and memory < self.job_memory:
+            return False
+        return os.getloadavg()[0] < self.max_load
+
+    @staticmethod
+    def next_job(pending, running):
+        # each recording serves its site on its --port of the host, so
+        # packages on the same port are recorded one after the other
+        busy = set(str(job_args.port) for _, job_args in running.values())
+        for job in pending:
+            if str(job[0].port) not in busy:
+                pending.remove(job)
+                return job
+        return None
+
+    def run(self, jobs):
+        pending = collections.deque(jobs)
+        running = {}
+        results = []
+        while pending or running:
+            # one start per poll so the last job's footprint shows up in
+            # the memory and load figures before the next is considered
+            job = None
+            if pending and self.can_start(len(running)):
+                job = self.next_job(pending, running)
+            if job is not None:
+                job_args, log_file = job
+                reader, writer = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(
+                    target=batch_job, args=(job_args, log_file, writer))
+                proc.start()
+                writer.close()
+                running[reader] = (proc, job_args)
+                logger.info("Started {} ({} running, {} pending)".format(
+                    job_args.pack[0], len(running), len(pending)))
+            ready = multiprocessing.connection.wait(
+                list(running), timeout=self.POLL if pending else None)
+            for reader in ready:
+                proc, job_args = running.pop(reader)
+                try:
+                    result = reader.recv()
+                except EOFError:
+                    result = {'pack': job_args.pack[0], 'status': 'failed',
+                              'error': 'worker died'}
+                proc.join()
+                if result['status'] != 'ok' and 'error' not in result:
+                    result['error'] = 'exit code {}'.format(proc.exitcode)
+                results.append(result)
+                logger.info("Finished {} [{}] in {}s".format(
+                    result['pack'], result['status'],
+                    result.get('seconds', '?')))
+        return results
+
+
+def phase_totals(results):
+    # where the batch spent its time, to tell which phase to speed up
+    totals = collections.Counter()
+    for result in results:
+        totals.update(result.get('phases', {}))
+    return dict((name, round(seconds, 3))
+                for name, seconds in totals.most_common())
+
+
+def batch_record(args):
+    if args.quiet:
+        logger.setLevel(30)
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    jobs = []
+    names = collections.Counter()
+    for pack, port in batch_packs(args.packs, args.port):
+        name = Path(pack).stem
+        names[name] += 1
+        if names[name] > 1:
+            name = '{}-{}'.format(name, names[name])
+        job_args = argparse.Namespace(**vars(args))
+        job_args.pack = [os.path.abspath(pack)]
+        job_args.target = [os.path.join(work_dir, name)]
+        job_args.port = port
+        job_args.crawl_report = (os.path.join(work_dir, name + '-crawl.json')
+                                 if args.crawl else None)
+        job_args.trace = os.path.join(work_dir, name + '.trace.json')
+        job_args.chrome_trace = None
+        jobs.append((job_args, os.path.join(work_dir, name + '.log')))
+
+    # recordings on the same port of the host can't overlap, see next_job
+    ports = collections.Counter(str(job_args.port) for job_args, _ in jobs)
+    parallel = min(args.jobs, len(jobs))
+    if len(ports) < parallel:
+        logger.warning(
+            "{} packages are served on {} port(s) ({}), so at most {} of "
+            "them are recorded at once instead of {}".format(
+                len(jobs), len(ports),
+                ', '.join('{} on {}'.format(count, port)
+                          for port, count in ports.most_common()),
+                len(ports), parallel))
+
+    if args.shared_browser and not args.browser:
+        session = Session(ready_timeout=args.ready_timeout)
+        register(session)
+        driver = Driver('record', session, headless=True)
+        driver.start()
+        register(driver)
+        for job_args, _ in jobs:
+            job_args.browser = driver.cdp_url()
+
+    started = time.monotonic()
+    scheduler = BatchScheduler(args.jobs, args.job_memory, args.max_load)
+    try:
+        results = scheduler.run(jobs)
+    finally:
+        subprocess_manager.shutdown()
+    report = {
+        'packs': len(results),
+        'failed': sum(1 for r in results if r['status'] != 'ok'),
+        'seconds': round(time.monotonic() - started, 3),
+        'pages': sum(r.get('pages', 0) for r in results),
+        'warc_bytes': sum(r.get('warc_bytes', 0) for r in results),
+        'phases': phase_totals(results),
+        'jobs': results
+    }
+    report_file = args.report or os.path.join(work_dir, 'batch-report.json')
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("{:<40} {:>7} {:>9} {:>6} {:>10}".format(
+        'package', 'status', 'seconds', 'pages', 'WARC MB'))
+    for r in results:
+        print("{:<40} {:>7} {:>9} {:>6} {:>10.1f}".format(
+            Path(r['pack']).name[:40], r['status'], r.get('seconds', 0),
+            r.get('pages', 0), r.get('warc_bytes', 0) / 1e6))
+    print("{} packages, {} failed, {} pages in {:.0f}s; "
+          "report written to {}".format(
+              report['packs'], report['failed'], report['pages'],
+              report['seconds'], report_file))
+    if report['failed']:
+        sys.exit(1)
+
+
+def browser(args):
+    if args.quiet:
+        logger.setLevel(30)
+    session = Session(ready_timeout=args.ready_timeout)
+    session.cdp_port = args.cdp_port
+    register(session)
+    driver = Driver('record', session, headless=not args.headed)
+    driver.start()
+    register(driver)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    print("Browser ready, record with --browser {}".format(driver.cdp_url()))
+    while driver.proc.poll() is None:
+        time.sleep(1)
+    logger.critical("Chromium exited with {}".format(driver.proc.returncode))
+    session.stop()
+    sys.exit(1)
+
+
+# uwsgi prints this once the pywb WSGI app has loaded in the container
+PYWB_READY_LINE = b"WSGI app 0 (mountpoint='') ready"
+
+
 def docker_pull_if_not_exists(client, image):
     try:
         client.images.get(image)
@@ -521,6 +2223,364 @@ def pywb_vols(target_dir, standalone=False):
     return dict((resource_path(k), {'bind': v}) for k, v in vols.items())
 
 
+def run_pywb(client, network, target_dir, site_container, site_port,
+             rpz_name, standalone, session):
+    vols = pywb_vols(target_dir, standalone)
+    logger.info("PYWB Container with volumes: {}".format(str(vols)))
+    return client.containers.run(
+        'webrecorder/pywb', detach=True, remove=True,
+        name=session.pywb_name, network=network.name,
+        volumes=vols, user='root',
+        ports={'8080/tcp': session.wayback_port},
+        environment=['RPZ_HOST=' + site_container.name +
+                     ':' + str(site_port),
+                     'RPZ_FAKE_URL=http://' + rpz_name])
+
+
+def wait_for_pywb(pywb_container, session):
+    session.readiness('pywb container').wait_for_container(
+        pywb_container, log_line=PYWB_READY_LINE)
+    Wayback.wait_for_service(session)
+
+
+def run_replay_proxy(client, network, site_container, site_port,
+                     server_name, session):
+    proxy_port = session.proxy_port
+    with open(resource_path('replay-proxy-nginx.conf')) as template:
+        conf_string = template.read()
+    for placeholder, value in [
+            ('PROXIED_SERVER', '{}:{}'.format(site_container.name,
+                                              site_port)),
+            ('SERVER_NAME', server_name),
+            ('PYWB_HOST', session.pywb_name),
+            ('PYWB_PORT', '8080'),
+            ('PROXY_PORT', str(proxy_port))]:
+        conf_string = conf_string.replace(placeholder, value)
+    conf_path = os.path.join(session.work_dir, 'replay-proxy.conf')
+    with open(conf_path, 'w') as conf_file:
+        conf_file.write(conf_string)
+
+    return client.containers.run(
+        'nginx', detach=True, remove=True,
+        name=session.proxy_name, network=network.name,
+        volumes={conf_path: {
+            'bind': '/etc/nginx/conf.d/server.conf', 'mode': 'ro'}},
+        ports={'{}/tcp'.format(proxy_port): proxy_port})
+
+
+# HTTP proxy run in-process in place of the nginx container: requests for
+# the server names of live apps go to their site, anything else goes to
+# pywb as a proxy request. Each listening port has its own routes, so one
+# proxy serves all the sessions of a warm pool
+class ReplayProxy(object):
+    HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-connection',
+                             'te', 'trailer', 'upgrade', 'expect',
+                             'proxy-authenticate', 'proxy-authorization'])
+    CHUNK_SIZE = 1 << 16
+    MAX_IDLE = 16
+    TIMEOUT = 60
+
+    def __init__(self, bind='localhost'):
+        self.bind = bind
+        self.loop = None
+        self.thread = None
+        self.listeners = {}
+        self.servers = {}
+        self.clients = set()
+        self.idle = collections.defaultdict(list)
+        self.counters = collections.defaultdict(
+            lambda: {'requests': 0, 'errors': 0, 'seconds': 0.0,
+                     'max_seconds': 0.0})
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def listen(self, port, routes, fallback):
+        """Serves port, sending requests for the server names in routes to
+        their (host, port) upstream and all others to pywb at fallback
+        """
+        if self.loop is None:
+            self.start()
+        self.listeners[port] = (
+            dict((name.lower(), upstream)
+                 for name, upstream in routes.items()), fallback)
+        self.servers[port] = self.call(asyncio.start_server(
+            lambda r, w: self.handle(port, r, w), self.bind, port))
+        logger.info("Replay proxy listening on port {}".format(port))
+
+    def unlisten(self, port):
+        server = self.servers.pop(port, None)
+        if server is not None:
+            server.close()
+            self.call(server.wait_closed())
+        self.listeners.pop(port, None)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        for port in list(self.servers):
+            self.unlisten(port)
+        self.call(self.close_clients())
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+        for route, stats in sorted(self.stats().items()):
+            logger.info("Proxy route {}: {} requests, {} errors, mean {} "
+                        "ms".format(route, stats['requests'],
+                                    stats['errors'], stats['mean_ms']))
+
+    async def close_clients(self):
+        for task in self.clients:
+            task.cancel()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+
+    def stats(self):
+        stats = {}
+        for (port, route), c in self.counters.items():
+            stats['{}:{}'.format(port, route)] = {
+                'requests': c['requests'],
+                'errors': c['errors'],
+                'mean_ms': round(1000 * c['seconds'] / c['requests'], 3)
+                if c['requests'] else None,
+                'max_ms': round(1000 * c['max_seconds'], 3)}
+        return stats
+
+    @staticmethod
+    def header(headers, name, default=None):
+        for key, value in headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    @staticmethod
+    async def read_head(reader):
+        try:
+            data = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise
+            return None
+        lines = data.decode('latin-1').split('\r\n')
+        first = lines[0].split(' ', 2)
+        headers = [tuple(part.strip() for part in line.split(':', 1))
+                   for line in lines[1:] if ':' in line]
+        return first, headers
+
+    def outgoing(self, headers, extra):
+        listed = set(h.strip().lower() for h in self.header(
+            headers, 'connection', '').split(','))
+        kept = [(k, v) for k, v in headers
+                if k.lower() not in self.HOP_HEADERS and
+                k.lower() not in listed]
+        return kept + extra
+
+    @staticmethod
+    def serialize(first_line, headers):
+        return ('\r\n'.join([first_line] + ['{}: {}'.format(k, v)
+                                            for k, v in headers]) +
+                '\r\n\r\n').encode('latin-1')
+
+    def framing(self, headers):
+        if 'chunked' in self.header(headers, 'transfer-encoding',
+                                    '').lower():
+            return 'chunked'
+        length = self.header(headers, 'content-length')
+        if length is not None:
+            return int(length)
+        return None
+
+    async def copy_body(self, reader, writer, framing):
+        """Copies a body as it comes, chunked framing included. Returns
+        False if it could only end with the connection
+        """
+        if framing == 'chunked':
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                writer.write(line)
+                size = int(line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    break
+                await self.copy_exact(reader, writer, size + 2)
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                writer.write(line)
+                if line == b'\r\n':
+                    break
+        elif framing is not None:
+            await self.copy_exact(reader, writer, framing)
+        else:
+            while True:
+                data = await reader.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+            return False
+        await writer.drain()
+        return True
+
+    async def copy_exact(self, reader, writer, size):
+        while size > 0:
+            data = await reader.readexactly(min(size, self.CHUNK_SIZE))
+            writer.write(data)
+            size -= len(data)
+            await writer.drain()
+
+    async def connect(self, upstream):
+        idle = self.idle[upstream]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*upstream), self.TIMEOUT)
+        return reader, writer, False
+
+    def release(self, upstream, connection):
+        if len(self.idle[upstream]) < self.MAX_IDLE:
+            self.idle[upstream].append(connection)
+        else:
+            connection[1].close()
+
+    async def handle(self, port, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else ''
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            while True:
+                head = await self.read_head(reader)
+                if head is None:
+                    break
+                if not await self.forward(port, head, reader, writer,
+                                          client_ip):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError) as e:
+            logger.debug("Proxy connection failed: {}".format(e))
+        except asyncio.CancelledError:
+            # cancelled by stop(); ending normally keeps asyncio's stream
+            # server from logging the cancellation as an error
+            pass
+        finally:
+            self.clients.discard(task)
+            writer.close()
+
+    def route(self, port, target, headers):
+        routes, fallback = self.listeners[port]
+        if '://' in target:
+            parts = urlsplit(target)
+            host = parts.netloc
+            path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        else:
+            host = self.header(headers, 'host', '')
+            path = target
+        name = host.rsplit(':', 1)[0].lower()
+        if name in routes:
+            return name, routes[name], path, [('X-Forwarded-Host', name)]
+        return 'pywb', fallback, 'http://' + host + path, []
+
+    async def forward(self, port, head, reader, writer, client_ip):
+        (method, target, version), headers = head
+        if method == 'CONNECT':
+            writer.write(b'HTTP/1.1 405 Method Not Allowed\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return False
+        keep_alive = version == 'HTTP/1.1' and 'close' not in (
+            self.header(headers, 'connection', '') + ',' +
+            self.header(headers, 'proxy-connection', '')).lower()
+        if '100-continue' in self.header(headers, 'expect', '').lower():
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        route, upstream, path, extra = self.route(port, target, headers)
+        forwarded = self.header(headers, 'x-forwarded-for')
+        extra += [('X-Real-IP', client_ip),
+                  ('X-Forwarded-For', '{}, {}'.format(forwarded, client_ip)
+                   if forwarded else client_ip),
+                  ('Connection', 'keep-alive')]
+        request_head = self.serialize(
+            '{} {} HTTP/1.1'.format(method, path),
+            self.outgoing([(k, v) for k, v in headers
+                           if k.lower() != 'x-forwarded-for'], extra))
+        request_framing = self.framing(headers)
+        has_body = request_framing not in (None, 0)
+
+        counters = self.counters[port, route]
+        counters['requests'] += 1
+        started = time.monotonic()
+        response = None
+        for attempt in range(2):
+            upstream_reader = upstream_writer = None
+            reused = False
+            try:
+                upstream_reader, upstream_writer, reused = \
+                    await self.connect(upstream)
+                upstream_writer.write(request_head)
+                if has_body:
+                    await self.copy_body(reader, upstream_writer,
+                                         request_framing)
+                await upstream_writer.drain()
+                response = await asyncio.wait_for(
+                    self.read_head(upstream_reader), self.TIMEOUT)
+                if response is None:
+                    raise ConnectionResetError('upstream closed')
+                break
+            except (OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                if upstream_writer is not None:
+                    upstream_writer.close()
+                # a kept-alive connection the upstream has since closed
+                if attempt == 0 and reused and not has_body:
+                    continue
+                logger.debug("Proxy to {} failed: {}".format(upstream, e))
+                break
+
+        elapsed = time.monotonic() - started
+        counters['seconds'] += elapsed
+        counters['max_seconds'] = max(counters['max_seconds'], elapsed)
+        if response is None:
+            counters['errors'] += 1
+            writer.write(b'HTTP/1.1 502 Bad Gateway\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return False
+
+        (_, status, *reason), response_headers = response
+        if status.startswith('5'):
+            counters['errors'] += 1
+        response_framing = self.framing(response_headers)
+        if method == 'HEAD' or status in ('204', '304') or \
+                status.startswith('1'):
+            response_framing = 0
+        reusable = response_framing is not None and 'close' not in \
+            self.header(response_headers, 'connection', '').lower()
+        keep_alive = keep_alive and response_framing is not None
+        writer.write(self.serialize(
+            ' '.join(['HTTP/1.1', status] + reason),
+            self.outgoing(response_headers, [
+                ('Connection', 'keep-alive' if keep_alive else 'close')])))
+        try:
+            await self.copy_body(upstream_reader, writer, response_framing)
+        except Exception:
+            upstream_writer.close()
+            raise
+        if reusable:
+            self.release(upstream, (upstream_reader, upstream_writer))
+        else:
+            upstream_writer.close()
+        return keep_alive
+
+
 def set_hostname(args):
     if not args.hostname:
         return 'rpzdj-repl.ay'
@@ -531,102 +2591,1040 @@ def set_hostname(args):
     return args.hostname[0]
 
 
-def playback(args):
-    if args.quiet:
-        logger.setLevel(30)
-    rpz_name = Path(args.pack[0]).name
-    replay_server_name = set_hostname(args)
-    network = site_container = pywb_container = proxy_container = None
-    proxy_port = 8081
-    target_dir = os.path.abspath(args.target[0])
-    try:
-        run_site(args)
-        site_container = find_container(Path(target_dir))
+# The site, pywb and proxy containers of a playback session on their own
+# network
+class PlaybackStack(object):
 
-        signal.signal(signal.SIGINT, shutdown)
+    def __init__(self, args, session):
+        self.args = args
+        self.session = session
+        self.rpz_name = Path(args.pack[0]).name
+        self.server_name = set_hostname(args)
+        self.target_dir = os.path.abspath(args.target[0])
+        self.network = self.site_container = None
+        self.pywb_container = self.proxy_container = None
+        self.proxy = None
 
-        logger.debug("Container {}".format(site_container.name))
+    def start(self):
+        args = self.args
+        args.host_port = self.session.site_port
+        run_site(args, self.session)
+        self.site_container = find_container(Path(self.target_dir))
+        logger.debug("Container {}".format(self.site_container.name))
 
         client = docker.from_env()
-        docker_pull_if_not_exists(client, 'nginx:latest')
+        builtin_proxy = getattr(args, 'builtin_proxy', False)
+        if not args.standalone and not builtin_proxy:
+            docker_pull_if_not_exists(client, 'nginx:latest')
         docker_pull_if_not_exists(client, 'webrecorder/pywb:latest')
 
-        network = client.networks.create(
-            "rpzdj_{}".format(time.time_ns()),
+        self.network = client.networks.create(
+            self.session.network_name,
             driver="bridge",
             attachable=True
         )
-        logger.info("PROXY NETWORK {}".format(network.name))
-        network.connect(site_container)
-
-        vols = pywb_vols(target_dir, args.standalone)
-        logger.info("PYWB Container with volumes: {}".format(str(vols)))
-        pywb_container = client.containers.run(
-            'webrecorder/pywb', detach=True, remove=True,
-            name='pywb-playback', network=network.name,
-            volumes=vols, user='root',
-            ports={'8080/tcp': Wayback.PORT},
-            environment=['RPZ_HOST=' + site_container.name +
-                         ':' + args.port,
-                         'RPZ_FAKE_URL=http://' + rpz_name])
-
-        register(pywb_container)
-        Wayback.wait_for_service(Wayback.PORT)
+        logger.info("PROXY NETWORK {}".format(self.network.name))
+        self.network.connect(self.site_container)
+
+        with tracer.span('pywb_start', standalone=args.standalone):
+            self.pywb_container = run_pywb(
+                client, self.network, self.target_dir, self.site_container,
+                args.port, self.rpz_name, args.standalone, self.session)
+            register(self.pywb_container)
+            wait_for_pywb(self.pywb_container, self.session)
+
+        if args.standalone:
+            return
+        with tracer.span('proxy_start', builtin=builtin_proxy):
+            if builtin_proxy:
+                self.proxy = ReplayProxy()
+                register(self.proxy)
+                self.proxy.listen(
+                    self.session.proxy_port,
+                    {self.server_name: ('localhost',
+                                        self.session.site_port)},
+                    ('localhost', self.session.wayback_port))
+            else:
+                self.proxy_container = run_replay_proxy(
+                    client, self.network, self.site_container, args.port,
+                    self.server_name, self.session)
+                register(self.proxy_container)
+
+    def url(self, path='/'):
+        if self.args.standalone:
+            return "http://localhost:{}/http://{}{}".format(
+                self.session.wayback_port, self.rpz_name, path)
+        return "http://{}{}".format(self.server_name, path)
+
+    def stop(self):
+        if not self.network:
+            return
+        self.network.disconnect(self.site_container)
+        if self.pywb_container is not None:
+            try:
+                self.network.disconnect(self.pywb_container)
+            except docker.errors.NotFound:
+                pass
+        if self.proxy_container is not None:
+            try:
+                self.network.disconnect(self.proxy_container)
+            except docker.errors.NotFound:
+                pass
+            except docker.errors.NullResource:
+                pass
+        self.network.remove()
+
+
+@traced('playback')
+def playback(args):
+    if args.quiet:
+        logger.setLevel(30)
+    session = Session(ready_timeout=args.ready_timeout)
+    register(session)
+    stack = PlaybackStack(args, session)
+    try:
+        stack.start()
+        signal.signal(signal.SIGINT, shutdown)
+        session.report_readiness()
 
         if args.standalone:
-            print("Point your browser to http://localhost:{}"
-                  "/http://{}".format(Wayback.PORT, rpz_name))
+            print("Point your browser to {}".format(stack.url('')))
         else:
-            conf_string = subprocess.check_output(
-                ['sed', '-e', 's/PROXIED_SERVER/{}:{}/'.format(
-                    site_container.name, args.port),
-                 '-e', 's/SERVER_NAME/{}/'.format(replay_server_name),
-                 '-e', 's/PYWB_PORT/{}/'.format(Wayback.PORT),
-                 '-e', 's/PROXY_PORT/{}/'.format(proxy_port),
-                 resource_path('replay-proxy-nginx.conf')])
-            conf_file = open(
-                'replay-proxy-for-{}.conf'.format(
-                    site_container.name), 'w')
-            conf_file.write(conf_string.decode())
-            conf_file.close()
-
-            proxy_container = client.containers.run(
-                'nginx', detach=True, remove=True,
-                name='replay-proxy', network=network.name,
-                volumes={'{}/replay-proxy-for-{}.conf'.format(
-                    os.getcwd(), site_container.name): {
-                        'bind': '/etc/nginx/conf.d/'
-                        'server.conf', 'mode': 'ro'}
-                }, ports={'{}/tcp'.format(proxy_port): proxy_port})
-            register(proxy_container)
-
-            driver = Driver.new_replay_driver()
+            driver = Driver.new_replay_driver(session)
             driver.start()
             register(driver)
-            driver.replay("http://{}".format(replay_server_name))
+            driver.replay(stack.url(''))
         input("Press Enter to quit")
     finally:
-        if network:
-            network.disconnect(site_container)
-            if pywb_container is not None:
-                try:
-                    network.disconnect(pywb_container)
-                except docker.errors.NotFound:
-                    pass
-            if not args.standalone and proxy_container is not None:
-                try:
-                    network.disconnect(proxy_container)
-                except docker.errors.NotFound:
-                    pass
-                except docker.errors.NullResource:
-                    pass
-            network.remove()
+        stack.stop()
         subprocess_manager.shutdown()
 
     cleanup(args)
     sys.exit(0)
 
 
+# Loads pages through a playback stack in a headless browser and measures
+# how fast they come back and where their resources are served from
+class Bench(object):
+    # see pywb/templates/not_found.html
+    NOT_FOUND_MARKER = 'Not Found in'
+    # standalone Wayback URLs, e.g. http://localhost:32771/mp_/http://site/
+    REPLAY_PREFIX = re.compile(r'^https?://localhost:\d+/(\d*[a-z]{2}_/)?'
+                               r'(?=https?://)')
+
+    def __init__(self, driver, stack, repeat=3, idle_time=None,
+                 max_wait=None):
+        self.driver = driver
+        self.stack = stack
+        self.repeat = repeat
+        self.idle_time = idle_time
+        self.max_wait = max_wait
+
+    def source(self, entry):
+        headers = dict((h['name'].lower(), h['value'])
+                       for h in entry['response']['headers'])
+        if 'x-rpz-source' in headers:
+            return headers['x-rpz-source']
+        host = urlsplit(entry['request']['url']).hostname
+        if host == self.stack.server_name:
+            return 'site'
+        return 'archive'
+
+    async def not_found(self, tab, profile):
+        urls = []
+        for entry in profile.entries:
+            if entry.get('status') != 404:
+                continue
+            try:
+                res = await tab.send('Network.getResponseBody',
+                                     {'requestId': entry['request_id']})
+            except CDPError:
+                continue
+            if self.NOT_FOUND_MARKER in res.get('body', ''):
+                urls.append(self.original_url(entry['url']))
+        return urls
+
+    def original_url(self, url):
+        """The URL as recorded, a path on the packaged site or the full URL
+        of another one, which is what `record --from-bench` expects
+        """
+        url = self.REPLAY_PREFIX.sub('', url)
+        parts = urlsplit(url)
+        if parts.hostname in (self.stack.server_name, self.stack.rpz_name):
+            return urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        return url
+
+    async def measure(self, url):
+        tab = await self.driver.open_tab()
+        try:
+            tracker = await self.driver.load(tab, url, self.idle_time,
+                                             self.max_wait)
+            profile = tracker.profile
+            page, entries = profile.har('page')
+            not_found = await self.not_found(tab, profile)
+        finally:
+            await self.driver.close_tab(tab)
+        document = next((e for e in entries
+                         if e['_resourceType'] == 'Document'), None)
+        ttfb = None
+        if document is not None:
+            timings = document['timings']
+            ttfb = round(sum(max(0, timings[k]) for k in (
+                'blocked', 'dns', 'connect', 'ssl', 'send', 'wait')), 3)
+        return {
+            'ttfb_ms': ttfb,
+            'load_ms': page['pageTimings']['onLoad'],
+            'requests': len(entries),
+            'failed': sum(1 for e in entries if '_error' in e),
+            'not_found': len(not_found),
+            'not_found_urls': not_found,
+            'timed_out': not tracker.idle(0),
+            'sources': dict(collections.Counter(
+                self.source(e) for e in entries))
+        }
+
+    def run(self, paths):
+        results = []
+        for path in paths:
+            url = self.stack.url(path)
+            runs = [self.driver.run(self.measure(url))
+                    for _ in range(self.repeat)]
+            results.append(self.summarize(path, runs))
+            logger.info("{}: ttfb {} ms, load {} ms, {} not found".format(
+                path, results[-1]['ttfb_ms']['median'],
+                results[-1]['load_ms']['median'],
+                results[-1]['not_found']))
+        return self.report(results)
+
+    @staticmethod
+    def stats(values):
+        values = sorted(v for v in values if v is not None and v >= 0)
+        if not values:
+            return {'median': None, 'mean': None, 'max': None}
+        return {'median': values[len(values) // 2],
+                'mean': round(sum(values) / len(values), 3),
+                'max': values[-1]}
+
+    def summarize(self, path, runs):
+        sources = collections.Counter()
+        for run in runs:
+            sources.update(run['sources'])
+        return {
+            'path': path,
+            'runs': len(runs),
+            'ttfb_ms': self.stats(r['ttfb_ms'] for r in runs),
+            'load_ms': self.stats(r['load_ms'] for r in runs),
+            'requests': max(r['requests'] for r in runs),
+            'failed': max(r['failed'] for r in runs),
+            'not_found': max(r['not_found'] for r in runs),
+            'not_found_urls': sorted(set(url for r in runs
+                                         for url in r['not_found_urls'])),
+            'timed_out': sum(1 for r in runs if r['timed_out']),
+            'sources': dict(sources)
+        }
+
+    def report(self, results):
+        sources = collections.Counter()
+        for result in results:
+            sources.update(result['sources'])
+        total = sum(sources.values())
+        return {
+            'mode': 'standalone' if self.stack.args.standalone else 'proxy',
+            'pages': len(results),
+            'not_found': sum(r['not_found'] for r in results),
+            'not_found_urls': sorted(set(url for r in results
+                                         for url in r['not_found_urls'])),
+            'source_ratios': dict((name, round(count / total, 4))
+                                  for name, count in sources.items())
+                             if total else {},
+            'ttfb_ms': self.stats(r['ttfb_ms']['median'] for r in results),
+            'load_ms': self.stats(r['load_ms']['median'] for r in results),
+            'per_page': results
+        }
+
+
+@traced('bench')
+def bench(args):
+    if args.quiet:
+        logger.setLevel(30)
+    paths = list(args.paths or [])
+    if args.urls:
+        with open(args.urls) as f:
+            paths.extend(line.strip() for line in f
+                         if line.strip() and not line.startswith('#'))
+    paths = [urlsplit(p).path or '/' if '://' in p else p
+             for p in paths or ['/']]
+    session = Session(ready_timeout=args.ready_timeout)
+    register(session)
+    stack = PlaybackStack(args, session)
+    try:
+        stack.start()
+        signal.signal(signal.SIGINT, shutdown)
+        driver = Driver('replay' if not args.standalone else 'bench',
+                        session, headless=True, profile=True)
+        driver.start()
+        register(driver)
+        report = Bench(driver, stack, args.repeat, args.idle_time,
+                       args.max_wait).run(paths)
+    finally:
+        stack.stop()
+        subprocess_manager.shutdown()
+    cleanup(args)
+
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.fail_on_not_found and report['not_found']:
+        sys.exit(1)
+
+
+# Writes the captures of a WARC collection to a tree of static files with
+# their links made relative, the packaged site at the root and other hosts
+# under _hosts/. Pages the site's links lead to but that were never
+# captured would be served by the live_filter backend during playback, so
+# they are reported rather than exported
+class StaticExport(object):
+    HOSTS_DIR = '_hosts'
+    REWRITTEN_MIMES = ('text/html', 'application/xhtml+xml', 'text/css')
+    REDIRECTS = ('301', '302', '303', '307', '308')
+    ATTR_RE = re.compile(
+        r'''(\s(?:href|src|action|poster|background|data-src)\s*=\s*)'''
+        r'''(["'])(.*?)\2''', re.I | re.S)
+    SRCSET_RE = re.compile(r'''(\ssrcset\s*=\s*)(["'])(.*?)\2''', re.I | re.S)
+    CSS_URL_RE = re.compile(r'''(url\(\s*)(["']?)([^"')]*?)\2(\s*\))''', re.I)
+    CSS_IMPORT_RE = re.compile(r'''(@import\s+)(["'])(.*?)\2''', re.I)
+    SKIPPED_SCHEMES = ('data:', 'javascript:', 'mailto:', 'tel:', 'about:',
+                       'blob:', '#')
+
+    def __init__(self, coll_path, output, site_url=None):
+        self.coll_path = Path(coll_path)
+        self.output = Path(output)
+        self.captures = {}
+        self.payloads = {}
+        self.skipped = []
+        self.site = None
+        self.aliases = set()
+        if site_url:
+            self.site = self.origin(site_url)
+        self.files = {}
+        self.live = collections.defaultdict(set)
+        self.written = 0
+        self.bytes = 0
+
+    @staticmethod
+    def origin(url):
+        return urlsplit(normalize_url(url))[:2]
+
+    def index_lines(self):
+        indexes = self.coll_path / 'indexes'
+        cdxj = sorted(indexes.glob('*.cdxj'))
+        if cdxj:
+            for path in cdxj:
+                with open(str(path), 'rb') as f:
+                    for line in f:
+                        yield line
+            return
+        # packed collections only keep the ZipNum cluster, whose blocks
+        # are gzip members that read back as one CDXJ
+        for path in sorted(indexes.glob('*.cdx.gz')):
+            with gzip.open(str(path), 'rb') as f:
+                for line in f:
+                    yield line
+
+    def read_index(self):
+        first_page = None
+        for line in self.index_lines():
+            urlkey, timestamp, data = line.decode('utf-8').split(' ', 2)
+            cdx = json.loads(data)
+            cdx['timestamp'] = timestamp
+            if '__wb_method=' in urlkey:
+                self.skipped.append({'url': cdx['url'], 'reason': 'method'})
+                continue
+            if cdx.get('mime') != 'warc/revisit':
+                if cdx.get('status', '-') == '-':
+                    continue
+                self.payloads.setdefault(cdx.get('digest'), cdx)
+            # the site is where recording started, at its earliest page
+            if cdx.get('status') == '200' and cdx.get('mime') == 'text/html' \
+                    and (first_page is None or
+                         timestamp < first_page['timestamp']):
+                first_page = cdx
+            key = normalize_url(cdx['url'])
+            if timestamp >= self.captures.get(key, {}).get('timestamp', ''):
+                self.captures[key] = cdx
+        if self.site is None and first_page is not None:
+            self.site = self.origin(first_page['url'])
+        return self.captures
+
+    def record(self, cdx):
+        from warcio.archiveiterator import ArchiveIterator
+        path = self.coll_path / 'archive' / cdx['filename']
+        with open(str(path), 'rb') as f:
+            f.seek(int(cdx['offset']))
+            record = next(iter(ArchiveIterator(f)))
+            return record.http_headers, record.content_stream().read()
+
+    def load(self, cdx):
+        """Returns the status, headers and decoded payload of a capture,
+        taking the payload of revisits from their original
+        """
+        http_headers, body = self.record(cdx)
+        if cdx.get('mime') == 'warc/revisit':
+            original = self.payloads.get(cdx.get('digest'))
+            if original is None:
+                return None
+            body = self.record(original)[1]
+        return http_headers.get_statuscode(), http_headers, body
+
+    def static_path(self, url, mime):
+        parts = urlsplit(url)
+        if parts[:2] == self.site or parts[:2] in self.aliases:
+            base = []
+        else:
+            base = [self.HOSTS_DIR, parts.netloc.replace(':', '_')]
+        segments = [s for s in parts.path.split('/') if s not in ('', '.',
+                                                                  '..')]
+        if mime in ('text/html', 'application/xhtml+xml'):
+            if parts.path.endswith('/') or not segments or \
+                    '.' not in segments[-1]:
+                segments.append('index.html')
+        elif not segments or parts.path.endswith('/'):
+            segments.append('index' + (
+                mimetypes.guess_extension(mime or '') or '.bin'))
+        elif '.' not in segments[-1]:
+            segments[-1] += mimetypes.guess_extension(mime or '') or ''
+        if parts.query:
+            name, ext = os.path.splitext(segments[-1])
+            segments[-1] = '{}@{}{}'.format(
+                name, hashlib.sha1(parts.query.encode()).hexdigest()[:8],
+                ext)
+        return '/'.join(base + segments)
+
+    def plan(self):
+        """Assigns a file to every capture that can be exported
+        """
+        for url, cdx in sorted(self.captures.items()):
+            status = cdx.get('status', '-')
+            mime = cdx.get('mime')
+            if mime == 'warc/revisit':
+                # the status is in the revisit's own headers, read on write
+                status = '200'
+                mime = self.payloads.get(cdx.get('digest'), {}).get('mime')
+            if status in self.REDIRECTS:
+                mime = 'text/html'
+            elif status != '200':
+                self.skipped.append({'url': url,
+                                     'reason': 'status ' + status})
+                continue
+            self.files[url] = self.static_path(url, mime)
+
+    def link(self, value, base_url, doc_path):
+        stripped = value.strip()
+        if not stripped or stripped.lower().startswith(self.SKIPPED_SCHEMES):
+            return value
+        url, _, fragment = urljoin(base_url, stripped).partition('#')
+        if urlsplit(url).scheme not in ('http', 'https'):
+            return value
+        key = normalize_url(url)
+        path = self.files.get(key)
+        if path is None:
+            if self.origin(url) == self.site or \
+                    self.origin(url) in self.aliases:
+                self.live[key].add(base_url)
+            return value
+        link = os.path.relpath(path, os.path.dirname(doc_path) or '.')
+        return link + ('#' + fragment if fragment else '')
+
+    def rewrite(self, text, base_url, doc_path, html):
+        def attr(match):
+            return (match.group(1) + match.group(2) +
+                    self.link(match.group(3), base_url, doc_path) +
+                    match.group(2))
+
+        def srcset(match):
+            candidates = []
+            for candidate in match.group(3).split(','):
+                words = candidate.strip().split(None, 1)
+                if words:
+                    words[0] = self.link(words[0], base_url, doc_path)
+                candidates.append(' '.join(words))
+            return (match.group(1) + match.group(2) + ', '.join(candidates) +
+                    match.group(2))
+
+        def css_url(match):
+            return (match.group(1) + match.group(2) +
+                    self.link(match.group(3), base_url, doc_path) +
+                    match.group(2) + match.group(4))
+
+        if html:
+            text = self.ATTR_RE.sub(attr, text)
+            text = self.SRCSET_RE.sub(srcset, text)
+        text = self.CSS_URL_RE.sub(css_url, text)
+        return self.CSS_IMPORT_RE.sub(attr, text)
+
+    def redirect_page(self, location, url, doc_path):
+        target = self.link(location, url, doc_path)
+        escaped = target.replace('&', '&amp;').replace('"', '&quot;')
+        return ('<!DOCTYPE html><meta charset="utf-8">'
+                '<meta http-equiv="refresh" content="0; url={0}">'
+                '<a href="{0}">{0}</a>\n'.format(escaped)).encode('utf-8')
+
+    def write(self, url, doc_path):
+        cdx = self.captures[url]
+        loaded = self.load(cdx)
+        if loaded is None:
+            self.skipped.append({'url': url, 'reason': 'missing payload'})
+            return
+        status, http_headers, body = loaded
+        if status in self.REDIRECTS:
+            body = self.redirect_page(
+                http_headers.get_header('Location', ''), url, doc_path)
+        else:
+            mime = (http_headers.get_header('Content-Type') or
+                    cdx.get('mime') or '').split(';')[0].strip().lower()
+            if mime in self.REWRITTEN_MIMES:
+                # latin-1 maps every byte to a character and back, so the
+                # document's own encoding survives the rewrite
+                body = self.rewrite(body.decode('latin-1'), url, doc_path,
+                                    mime != 'text/css').encode('latin-1')
+        dest = self.output / doc_path
+        try:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(dest), 'wb') as f:
+                f.write(body)
+        except OSError as e:
+            self.skipped.append({'url': url, 'reason': 'conflict: {}'.format(
+                e.strerror)})
+            return
+        self.written += 1
+        self.bytes += len(body)
+
+    def run(self):
+        self.read_index()
+        if self.site is None:
+            raise MissingWARCData(self.coll_path / 'indexes')
+        self.plan()
+        for url, doc_path in sorted(self.files.items()):
+            self.write(url, doc_path)
+        return self.report()
+
+    def report(self):
+        return {
+            'site': urlunsplit(self.site + ('', '', '')),
+            'output': str(self.output),
+            'exported': self.written,
+            'bytes': self.bytes,
+            'live': [{'url': url, 'referrers': sorted(referrers)}
+                     for url, referrers in sorted(self.live.items())],
+            'skipped': self.skipped
+        }
+
+
+def export(args):
+    if args.quiet:
+        logger.setLevel(30)
+    output = Path(args.output[0])
+    if output.exists() and any(output.iterdir()):
+        logger.critical("Output directory exists and is not empty")
+        sys.exit(1)
+    source = Path(args.pack[0])
+    staging = None
+    try:
+        if source.is_dir():
+            coll_path = source / 'collections' / 'warc-data'
+        else:
+            staging = Path(tempfile.mkdtemp(prefix='rpzdj_export_'))
+            extract_warc_data(str(source), staging)
+            coll_path = staging / 'collections' / 'warc-data'
+        exporter = StaticExport(coll_path, output, args.site_url)
+        exporter.aliases.add(StaticExport.origin('http://' + source.name))
+        report = exporter.run()
+    finally:
+        if staging is not None:
+            shutil.rmtree(str(staging))
+
+    logger.info("Exported {} files ({:.1f} MB) to {}, {} URLs need the "
+                "live site, {} captures skipped".format(
+                    report['exported'], report['bytes'] / 1e6, output,
+                    len(report['live']), len(report['skipped'])))
+    output_json = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output_json)
+    else:
+        print(output_json)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def free_ports(count):
+    # keeps every socket bound until all are picked so no port comes twice
+    socks = [socket.socket() for _ in range(count)]
+    try:
+        for sock in socks:
+            sock.bind(('', 0))
+        return [sock.getsockname()[1] for sock in socks]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+@contextlib.contextmanager
+def cache_lock(cache_file):
+    """Serializes the read-modify-write of a cache file shared by the
+    concurrent jobs of batch-record
+    """
+    with open(cache_file + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_cache(cache_file):
+    # a missing or corrupt file is a cache miss
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_cache(cache_file, data):
+    # readers only ever see a complete file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file),
+                               prefix=os.path.basename(cache_file) + '.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, cache_file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def package_digest(rpz_file, cache_file=None):
+    """Digest of the RPZ's config and data tarball, memoized on the file's
+    path, size and mtime since hashing multi-GB packages takes a while
+    """
+    rpz_file = os.path.abspath(str(rpz_file))
+    stat = os.stat(rpz_file)
+    memo_key = '{}:{}:{}'.format(rpz_file, stat.st_size, stat.st_mtime)
+    if cache_file:
+        memo = read_cache(cache_file)
+        if memo_key in memo:
+            return memo[memo_key]
+
+    digest = hashlib.sha256()
+    with tarfile.open(rpz_file) as tar:
+        for name in ('METADATA/config.yml', 'DATA.tar.gz'):
+            try:
+                member = tar.extractfile(name)
+            except KeyError:
+                continue
+            for chunk in iter(lambda: member.read(1 << 20), b''):
+                digest.update(chunk)
+
+    if cache_file:
+        with cache_lock(cache_file):
+            memo = read_cache(cache_file)
+            memo[memo_key] = digest.hexdigest()
+            write_cache(cache_file, memo)
+    return digest.hexdigest()
+
+
+# Site images built by reprounzip-docker, tagged with the digest of the
+# package they were built from so later runs of the same RPZ skip the
+# unpack and build. Least recently used images are removed once the cache
+# grows over its disk budget
+class ImageCache(object):
+    REPOSITORY = 'rpzdj-cache'
+    DIR = os.environ.get('RPZDJ_CACHE_DIR', os.path.join(
+        os.path.expanduser('~'), '.cache', 'reprozip-web'))
+    BUDGET = 20
+
+    def __init__(self, cache_dir=None, budget=None):
+        self.cache_dir = cache_dir or self.DIR
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.budget = (self.BUDGET if budget is None else budget) * 1e9
+        self.used_file = os.path.join(self.cache_dir, 'images.json')
+        self.client = docker.from_env()
+
+    def tag(self, digest):
+        return '{}:{}'.format(self.REPOSITORY, digest[:16])
+
+    def lookup(self, digest):
+        try:
+            return self.client.images.get(self.tag(digest))
+        except docker.errors.ImageNotFound:
+            return None
+
+    def touch(self, tag):
+        with cache_lock(self.used_file):
+            used = read_cache(self.used_file)
+            used[tag] = time.time()
+            write_cache(self.used_file, used)
+
+    def setup(self, args):
+        digest = package_digest(args.pack[0],
+                                os.path.join(self.cache_dir, 'digests.json'))
+        tag = self.tag(digest)
+        if self.lookup(digest) is not None:
+            logger.info("Reusing cached image {}".format(tag))
+            self.setup_target(args.pack[0], args.target[0], tag)
+        else:
+            logger.info("Building image {}".format(tag))
+            args.image_name = [tag.encode('ascii')]
+            docker_setup(args)
+        self.touch(tag)
+        self.collect()
+
+    def setup_target(self, rpz_file, target, tag):
+        # what docker_setup leaves behind minus the data tarball, which is
+        # only needed to build the image
+        target = rpaths.Path(str(target))
+        target.mkdir(parents=True)
+        pack = RPZPack(str(rpz_file))
+        try:
+            pack.extract_config(target / 'config.yml')
+        finally:
+            pack.close()
+        config = load_config(target / 'config.yml', True)
+        unpacked_info = metadata_initial_iofiles(config)
+        unpacked_info['initial_image'] = tag.encode('ascii')
+        unpacked_info['current_image'] = tag.encode('ascii')
+        write_dict(target, unpacked_info)
+
+    def collect(self):
+        used = read_cache(self.used_file)
+        removed = []
+        images = []
+        for image in self.client.images.list(name=self.REPOSITORY):
+            for tag in image.tags:
+                if tag.startswith(self.REPOSITORY + ':'):
+                    images.append((used.get(tag, 0), tag, image))
+        images.sort(key=lambda entry: entry[0])
+        total = sum(image.attrs.get('Size', 0) for _, _, image in images)
+        for _, tag, image in images:
+            if total <= self.budget:
+                break
+            try:
+                self.client.images.remove(tag)
+            except docker.errors.APIError as e:
+                # still used by a container of another run
+                logger.debug("Keeping cached image {}: {}".format(tag, e))
+                continue
+            logger.info("Removed cached image {}".format(tag))
+            total -= image.attrs.get('Size', 0)
+            removed.append(tag)
+        if removed:
+            # other jobs may have touched their images in the meantime
+            with cache_lock(self.used_file):
+                used = read_cache(self.used_file)
+                for tag in removed:
+                    used.pop(tag, None)
+                write_cache(self.used_file, used)
+
+
+# The site, pywb and proxy containers serving one package in the warm pool
+class WarmStack(object):
+
+    def __init__(self, pool, pack, site_port, digest):
+        self.pool = pool
+        self.pack = pack
+        self.rpz_name = Path(pack).name
+        self.site_port = site_port
+        self.digest = digest
+        self.target_dir = str(Path(pool.pool_dir) / digest[:16])
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.site_container = None
+        self.containers = []
+        self.resources = None
+
+    @property
+    def running(self):
+        return self.site_container is not None
+
+    def site_args(self):
+        return argparse.Namespace(
+            pack=[self.pack], target=[self.target_dir],
+            port=str(self.site_port), host_port=self.resources.site_port,
+            skip_setup=os.path.exists(self.target_dir), skip_run=False,
+            reuse_image=True, image_cache_size=None, quiet=self.pool.quiet)
+
+    def start(self):
+        client = self.pool.client
+        network = self.pool.network
+        started = time.monotonic()
+        self.resources = Session('rpzdj-{}'.format(self.digest[:12]),
+                                 self.pool.ready_timeout)
+        run_site(self.site_args(), self.resources)
+        self.site_container = find_container(Path(self.target_dir))
+        network.connect(self.site_container)
+
+        pywb_container = run_pywb(
+            client, network, self.target_dir, self.site_container,
+            self.site_port, self.rpz_name, self.pool.standalone,
+            self.resources)
+        self.containers.append(pywb_container)
+        wait_for_pywb(pywb_container, self.resources)
+
+        if self.pool.proxy is not None:
+            self.pool.proxy.listen(
+                self.resources.proxy_port,
+                {self.pool.server_name: ('localhost',
+                                         self.resources.site_port)},
+                ('localhost', self.resources.wayback_port))
+        elif not self.pool.standalone:
+            self.containers.append(run_replay_proxy(
+                client, network, self.site_container, self.site_port,
+                self.pool.server_name, self.resources))
+        logger.info("Warmed up {} in {:.1f}s".format(
+            self.rpz_name, time.monotonic() - started))
+
+    def stop(self):
+        if self.pool.proxy is not None and self.resources is not None:
+            self.pool.proxy.unlisten(self.resources.proxy_port)
+        for container in self.containers + [self.site_container]:
+            if container is None:
+                continue
+            try:
+                self.pool.network.disconnect(container)
+            except docker.errors.APIError:
+                pass
+            try:
+                container.stop()
+            except docker.errors.NotFound:
+                pass
+        try:
+            self.site_container.remove()
+        except (AttributeError, docker.errors.NotFound):
+            pass
+        self.site_container = None
+        self.containers = []
+        if self.resources is not None:
+            self.resources.stop()
+
+    def session(self):
+        with self.lock:
+            if not self.running:
+                self.start()
+            self.last_used = time.monotonic()
+        info = {'pack': self.pack,
+                'digest': self.digest,
+                'url': 'http://localhost:{}/http://{}'.format(
+                    self.resources.wayback_port, self.rpz_name)}
+        if not self.pool.standalone:
+            info['proxy'] = 'localhost:{}'.format(self.resources.proxy_port)
+            info['hostname'] = self.pool.server_name
+        return info
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_used
+
+
+# Keeps site images and replay containers warm per package and hands out
+# playback sessions, stopping the containers of idle packages
+class WarmPool(object):
+
+    def __init__(self, pool_dir, idle_timeout=1800, standalone=True,
+                 server_name='rpzdj-repl.ay', quiet=False,
+                 builtin_proxy=False, ready_timeout=Readiness.DEADLINE):
+        self.pool_dir = os.path.abspath(pool_dir)
+        os.makedirs(self.pool_dir, exist_ok=True)
+        self.idle_timeout = idle_timeout
+        self.standalone = standalone
+        self.server_name = server_name
+        self.quiet = quiet
+        self.ready_timeout = ready_timeout
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self.client = docker.from_env()
+        docker_pull_if_not_exists(self.client, 'webrecorder/pywb:latest')
+        self.proxy = None
+        if not standalone:
+            if builtin_proxy:
+                self.proxy = ReplayProxy()
+            else:
+                docker_pull_if_not_exists(self.client, 'nginx:latest')
+        try:
+            self.network = self.client.networks.get('rpzdj_pool')
+        except docker.errors.NotFound:
+            self.network = self.client.networks.create(
+                'rpzdj_pool', driver='bridge', attachable=True)
+
+    def session(self, pack, site_port):
+        digest = package_digest(
+            pack, os.path.join(self.pool_dir, 'digests.json'))
+        with self.lock:
+            stack = self.stacks.get(digest)
+            if stack is None:
+                stack = WarmStack(self, pack, site_port, digest)
+                self.stacks[digest] = stack
+        return stack.session()
+
+    def status(self):
+        with self.lock:
+            stacks = list(self.stacks.values())
+        return [{'pack': s.pack, 'digest': s.digest, 'running': s.running,
+                 'idle_seconds': round(s.idle_seconds(), 1)}
+                for s in stacks]
+
+    def evict_idle(self):
+        with self.lock:
+            stacks = list(self.stacks.values())
+        for stack in stacks:
+            with stack.lock:
+                if stack.running and stack.idle_seconds() > self.idle_timeout:
+                    logger.info("Stopping idle {}".format(stack.rpz_name))
+                    stack.stop()
+
+    def run_evictor(self, interval=30):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+
+    def stop(self):
+        for stack in list(self.stacks.values()):
+            if stack.running:
+                stack.stop()
+        if self.proxy is not None:
+            self.proxy.stop()
+
+
+class WarmPoolHandler(BaseHTTPRequestHandler):
+    pool = None
+    # sessions are only started for the packages under this directory
+    pack_dir = None
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/status':
+            return self.send_error(404)
+        self.send_json(self.pool.status())
+
+    def do_POST(self):
+        # starting a session unpacks a package and runs its containers: a
+        # JSON body can't be sent cross-site by a web page without a CORS
+        # preflight, which this server never allows
+        if urlsplit(self.path).path != '/session':
+            return self.send_error(404)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.split(';', 1)[0].strip() != 'application/json':
+            return self.send_error(415, "Expected application/json")
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length).decode())
+            pack = self.pack_path(query['pack'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.send_error(400, "Expected {\"pack\": <rpz>}")
+        if pack is None:
+            return self.send_error(403, "Not a package under {}".format(
+                self.pack_dir))
+        try:
+            body = self.pool.session(pack, query.get('port', 80))
+        except Exception as e:
+            logger.exception("Session failed")
+            return self.send_error(500, str(e))
+        self.send_json(body)
+
+    @classmethod
+    def pack_path(cls, name):
+        path = os.path.realpath(os.path.join(cls.pack_dir, name))
+        if not path.startswith(os.path.join(cls.pack_dir, '')) or \
+                not os.path.isfile(path):
+            return None
+        return path
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(args):
+    global tracer
+    # nothing writes the trace of the daemon, its spans would pile up
+    tracer = Tracer(enabled=False)
+    if args.quiet:
+        logger.setLevel(30)
+    pool = WarmPool(args.pool_dir[0], args.idle_timeout, args.standalone,
+                    set_hostname(args), args.quiet, args.builtin_proxy,
+                    args.ready_timeout)
+    register(pool)
+    signal.signal(signal.SIGINT, shutdown)
+    pool.run_evictor()
+    WarmPoolHandler.pool = pool
+    WarmPoolHandler.pack_dir = os.path.realpath(args.pack_dir)
+    server = ThreadingHTTPServer((args.bind, args.listen), WarmPoolHandler)
+    logger.info("Serving playback sessions of the packages in {} on "
+                "http://{}:{}/session".format(WarmPoolHandler.pack_dir,
+                                              args.bind, args.listen))
+    try:
+        server.serve_forever()
+    finally:
+        subprocess_manager.shutdown()
+
+
+def add_recording_arguments(parser):
+    parser.add_argument('--headless', action='store_true',
+                        help="run Chromium without a window")
+    parser.add_argument('--browser', help="record in a browser context of "
+                        "the Chromium at this DevTools URL, as started by "
+                        "'reprounzip dj browser', instead of starting one")
+    parser.add_argument('--no-profile', dest='profile',
+                        action='store_false', help="don't write the "
+                        "timings and sizes of the recorded requests to a "
+                        "HAR file in the package")
+    parser.add_argument('--idle-time', dest='idle_time',
+                        type=float, default=Driver.IDLE_TIME,
+                        help="seconds without network activity "
+                        "after which a page counts as recorded")
+    parser.add_argument('--max-wait', dest='max_wait',
+                        type=float, default=Driver.MAX_WAIT,
+                        help="maximum seconds to spend recording "
+                        "a page")
+    parser.add_argument('--crawl', action='store_true',
+                        help="follow same-origin links and record "
+                        "every page reached")
+    parser.add_argument('--seeds', help="file with additional "
+                        "URLs or paths to crawl, one per line")
+    parser.add_argument('--sitemap', help="sitemap URL or path "
+                        "whose pages are added to the crawl")
+    parser.add_argument('--tabs', type=int, default=4,
+                        help="number of pages recorded "
+                        "concurrently when crawling")
+    parser.add_argument('--max-depth', dest='max_depth', type=int,
+                        default=2, help="maximum number of links "
+                        "followed from a seed")
+    parser.add_argument('--max-pages', dest='max_pages', type=int,
+                        default=100, help="maximum number of pages "
+                        "to crawl")
+    parser.add_argument('--requeue-misses', dest='requeue_misses',
+                        action='store_true', help="record again, as pages "
+                        "of their own, the requests of a page that went "
+                        "to the live web or failed")
+
+
 def setup(parser, **kwargs):
     """Records site assets to a warc file and playbacks the site
 
@@ -637,16 +3635,34 @@ def setup(parser, **kwargs):
     playback                  Playback the site using the warc.
                             (includes reprounzip docker run)
 
+    serve                   Keep packages warm and hand out playback
+                            sessions over HTTP
+
+    batch-record            Record many packages in parallel
+
+    browser                 Run a headless Chromium that recordings can
+                            share with --browser
+
+    bench                   Measure the load times and completeness of
+                            pages played back from the package
+
+    export                  Write the recorded pages as static files
+
     For example:
 
         $ reprounzip dj record my_data_journalism_site.rpz target [--port]
         $ reprounzip dj playback my_data_journalism_site.rpz target [--port]
+        $ reprounzip dj serve pool_dir [--listen]
+        $ reprounzip dj batch-record packages/ --work-dir work [--jobs]
+        $ reprounzip dj browser [--cdp-port]
+        $ reprounzip dj bench my_data_journalism_site.rpz target / /about
+        $ reprounzip dj export my_data_journalism_site.rpz static/
 
     """
     subparsers = parser.add_subparsers(title="actions",
                                        metavar='', help=argparse.SUPPRESS)
 
-    for mode in ['playback', 'record', 'live-record']:
+    for mode in ['playback', 'record', 'live-record', 'bench']:
         parser = subparsers.add_parser(mode)
         parser.set_defaults(func=globals()[mode.replace("-", "_")])
         if mode == 'live-record':
@@ -655,12 +3671,16 @@ def setup(parser, **kwargs):
         else:
             parser.add_argument('pack', nargs=1, help="RPZ file")
 
-        if mode == 'playback':
+        if mode == 'playback' or mode == 'bench':
             parser.add_argument('--standalone', action='store_true',
                                 help="run in webserver mode and view in "
                                 "any browser")
             parser.add_argument('--hostname', nargs=1, help="specify the "
                                 "hostname for the proxy server")
+            parser.add_argument('--builtin-proxy', dest='builtin_proxy',
+                                action='store_true', help="route requests "
+                                "between the site and pywb in this process "
+                                "instead of an nginx container")
 
         parser.add_argument('target', nargs=1, help="target "
                             "directory")
@@ -675,13 +3695,152 @@ def setup(parser, **kwargs):
                             help="Keep reprozip docker "
                             "image, container, and target "
                             "dir after recording or playback")
+        parser.add_argument('--no-reuse-image', dest='reuse_image',
+                            action='store_false',
+                            help="always build the site image from the "
+                            "package and remove it afterwards instead of "
+                            "using the image cache")
+        parser.add_argument('--image-cache-size', dest='image_cache_size',
+                            type=float, default=ImageCache.BUDGET,
+                            help="disk budget in GB of cached site images")
         if mode == 'record':
             parser.add_argument('--skip-record',
                                 action='store_true',
                                 help="Simply write WARC data from "
                                 "<target> back to <pack>")
+            parser.add_argument('--incremental', action='store_true',
+                                help="add to the WARC data of an already "
+                                "recorded package, only recording pages "
+                                "it doesn't have yet")
+            parser.add_argument('--from-bench', dest='from_bench',
+                                help="with --incremental, also record the "
+                                "URLs this 'reprounzip dj bench' report "
+                                "found missing")
         if mode == 'record' or mode == 'live-record':
             parser.add_argument('--keep-browser', action='store_true',
                                 help="Keep the Chromium "
                                 "browser open for manual recording")
+            add_recording_arguments(parser)
+            parser.add_argument('--crawl-report', dest='crawl_report',
+                                help="write per-page crawl timings as JSON "
+                                "to this file")
+        if mode == 'bench':
+            parser.add_argument('paths', nargs='*', help="paths or URLs "
+                                "of the pages to load (default: /)")
+            parser.add_argument('--urls', help="file listing paths or URLs "
+                                "of pages to load, one per line")
+            parser.add_argument('--repeat', type=int, default=3,
+                                help="number of times each page is loaded")
+            parser.add_argument('--idle-time', dest='idle_time',
+                                type=float, default=Driver.IDLE_TIME,
+                                help="seconds without network activity "
+                                "after which a page counts as loaded")
+            parser.add_argument('--max-wait', dest='max_wait',
+                                type=float, default=Driver.MAX_WAIT,
+                                help="maximum seconds to wait for a page")
+            parser.add_argument('--report', help="write the JSON report to "
+                                "this file instead of the standard output")
+            parser.add_argument('--fail-on-not-found', action='store_true',
+                                dest='fail_on_not_found',
+                                help="exit with an error if any resource "
+                                "was missing from the archive")
+        parser.add_argument('--ready-timeout', dest='ready_timeout',
+                            type=float, default=Readiness.DEADLINE,
+                            help="seconds to wait for each service "
+                            "(site, wayback, browser) to come up")
+        parser.add_argument('--trace', help="write the timeline of the "
+                            "run's phases as JSON to this file")
+        parser.add_argument('--chrome-trace', dest='chrome_trace',
+                            help="write the timeline in the trace event "
+                            "format of chrome://tracing to this file")
         parser.add_argument('--quiet', action='store_true', help="shhhhhhh")
+
+    parser = subparsers.add_parser('serve')
+    parser.set_defaults(func=serve)
+    parser.add_argument('pool_dir', nargs=1, help="directory where "
+                        "packages are unpacked and kept between sessions")
+    parser.add_argument('--listen', type=int, default=8090,
+                        help="port of the session API")
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help="address the session API listens on")
+    parser.add_argument('--pack-dir', dest='pack_dir', required=True,
+                        help="directory of the packages sessions can be "
+                        "requested for")
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float,
+                        default=1800, help="seconds after which the "
+                        "containers of an unused package are stopped")
+    parser.add_argument('--standalone', action='store_true',
+                        help="only serve packages through pywb, without "
+                        "the host-routing proxy")
+    parser.add_argument('--hostname', nargs=1, help="specify the "
+                        "hostname for the proxy server")
+    parser.add_argument('--builtin-proxy', dest='builtin_proxy',
+                        action='store_true', help="route requests of all "
+                        "sessions in this process instead of an nginx "
+                        "container per package")
+    parser.add_argument('--ready-timeout', dest='ready_timeout',
+                        type=float, default=Readiness.DEADLINE,
+                        help="seconds to wait for each service to come up")
+    parser.add_argument('--quiet', action='store_true', help="shhhhhhh")
+
+    parser = subparsers.add_parser('batch-record')
+    parser.set_defaults(func=batch_record)
+    parser.add_argument('packs', nargs='+', help="RPZ files or directories "
+                        "of RPZ files, optionally as <pack>:<port>")
+    parser.add_argument('--work-dir', dest='work_dir', default='batch',
+                        help="directory for the target directories, logs "
+                        "and report of the jobs")
+    parser.add_argument('--port', dest='port', default=80,
+                        help="webserver port of packages given without one")
+    parser.add_argument('--jobs', type=int,
+                        default=max(1, (os.cpu_count() or 2) // 2),
+                        help="maximum number of packages recorded at once")
+    parser.add_argument('--job-memory', dest='job_memory', type=float,
+                        default=2, help="GB of available memory needed to "
+                        "start another job")
+    parser.add_argument('--max-load', dest='max_load', type=float,
+                        default=os.cpu_count() or 1, help="load average "
+                        "above which no new job is started")
+    parser.add_argument('--report', help="file the JSON summary is "
+                        "written to (default: <work-dir>/batch-report.json)")
+    parser.add_argument('--shared-browser', dest='shared_browser',
+                        action='store_true', help="record every package in "
+                        "its own context of one headless Chromium")
+    add_recording_arguments(parser)
+    parser.set_defaults(skip_setup=False, skip_run=False, skip_destroy=False,
+                        skip_record=False, keep_browser=False)
+    parser.add_argument('--no-reuse-image', dest='reuse_image',
+                        action='store_false',
+                        help="build the site images instead of using the "
+                        "image cache")
+    parser.add_argument('--image-cache-size', dest='image_cache_size',
+                        type=float, default=ImageCache.BUDGET,
+                        help="disk budget in GB of cached site images")
+    parser.add_argument('--ready-timeout', dest='ready_timeout',
+                        type=float, default=Readiness.DEADLINE,
+                        help="seconds to wait for each service to come up")
+    parser.add_argument('--quiet', action='store_true', help="shhhhhhh")
+
+    parser = subparsers.add_parser('export')
+    parser.set_defaults(func=export)
+    parser.add_argument('pack', nargs=1, help="RPZ file, or target "
+                        "directory of a recording")
+    parser.add_argument('output', nargs=1, help="directory the static "
+                        "files are written to")
+    parser.add_argument('--site-url', dest='site_url', help="origin of the "
+                        "packaged site (default: that of the earliest "
+                        "captured page)")
+    parser.add_argument('--report', help="write the JSON report to this "
+                        "file instead of the standard output")
+    parser.add_argument('--quiet', action='store_true', help="shhhhhhh")
+
+    parser = subparsers.add_parser('browser')
+    parser.set_defaults(func=browser)
+    parser.add_argument('--cdp-port', dest='cdp_port', type=int,
+                        default=9222, help="DevTools port of the browser")
+    parser.add_argument('--headed', action='store_true',
+                        help="show the browser window")
+    parser.add_argument('--ready-timeout', dest='ready_timeout',
+                        type=float, default=Readiness.DEADLINE,
+                        help="seconds to wait for the browser to come up")
+    parser.add_argument('--quiet', action='store_true', help="shhhhhhh")
@@ -15,6 +15,6 @@ setup(name='reprozip-web',
           'requests',
           'pywb',
           'pyppeteer',
-          'pychrome',
+          'websockets',
           'docker'],
       description="Allows the ReproZip unpacker to record and replay web applications packaged as .rpz files")
@@ -0,0 +1,31 @@
+import argparse
+import collections
+
+from reprounzip.unpackers import dj
+
+
+def job(pack, port):
+    return argparse.Namespace(pack=[pack], port=port), pack + '.log'
+
+
+def test_next_job_skips_ports_in_use():
+    pending = collections.deque([job('a', '80'), job('b', '80'),
+                                 job('c', '3000')])
+    running = {}
+    started = []
+    for _ in range(3):
+        next_job = dj.BatchScheduler.next_job(pending, running)
+        if next_job is None:
+            break
+        started.append(next_job[0].pack[0])
+        running[len(running)] = (None, next_job[0])
+    assert started == ['a', 'c']
+    assert [job_args.pack[0] for job_args, _ in pending] == ['b']
+
+
+def test_batch_packs_reads_ports(tmp_path):
+    for name in ('a.rpz', 'b.rpz'):
+        (tmp_path / name).touch()
+    assert list(dj.batch_packs([str(tmp_path), 'c.rpz:3000'], '80')) == [
+        (str(tmp_path / 'a.rpz'), '80'), (str(tmp_path / 'b.rpz'), '80'),
+        ('c.rpz', '3000')]
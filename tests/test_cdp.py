@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from reprounzip.unpackers import dj
+
+
+class FakeBrowser(object):
+    """Answers every command and follows Page.navigate with a network
+    event of the tab, as Chromium does
+    """
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.methods = []
+
+    async def send(self, data):
+        message = json.loads(data)
+        self.methods.append(message['method'])
+        result = {'targetId': 'target', 'sessionId': 'session'}
+        await self.incoming.put({'id': message['id'], 'result': result})
+        if message['method'] == 'Page.navigate':
+            await self.incoming.put({'sessionId': 'session',
+                                     'method': 'Network.requestWillBeSent',
+                                     'params': {}})
+
+    async def recv(self):
+        return json.dumps(await self.incoming.get())
+
+    async def close(self):
+        pass
+
+
+def test_open_page_does_not_queue_events_of_the_tab():
+    async def run():
+        browser = FakeBrowser()
+        driver = object.__new__(dj.Driver)
+        driver.context_id = None
+        driver.cdp = dj.CDPConnection(browser)
+        await driver.open_page('http://localhost/')
+        # lets the reader route the event sent after the navigation
+        while not browser.incoming.empty():
+            await asyncio.sleep(0)
+        await driver.cdp.close()
+        return browser, driver.cdp
+
+    browser, cdp = asyncio.run(run())
+    assert browser.methods == ['Target.createTarget', 'Target.attachToTarget',
+                               'Page.navigate']
+    assert cdp.sessions == {}
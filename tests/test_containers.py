@@ -0,0 +1,73 @@
+import concurrent.futures
+import hashlib
+import io
+import json
+import tarfile
+import types
+
+from reprounzip.unpackers import dj
+
+
+def fake_docker(monkeypatch, current_image, tags_by_container):
+    containers = [types.SimpleNamespace(name=name,
+                                        image=types.SimpleNamespace(tags=tags))
+                  for name, tags in tags_by_container]
+    client = types.SimpleNamespace(containers=types.SimpleNamespace(
+        list=lambda: containers))
+    monkeypatch.setattr(dj, 'read_dict',
+                        lambda target: {'current_image': current_image})
+    monkeypatch.setattr(dj.docker, 'from_env', lambda: client)
+
+
+def test_find_container_of_cached_image(monkeypatch, tmp_path):
+    fake_docker(monkeypatch, b'rpzdj-cache:0123456789abcdef', [
+        ('other', ['nginx:latest']),
+        ('site', ['rpzdj-cache:0123456789abcdef'])])
+    assert dj.find_container(tmp_path).name == 'site'
+
+
+def test_find_container_of_built_image(monkeypatch, tmp_path):
+    fake_docker(monkeypatch, b'reprounzip_image_abc', [
+        ('site', ['reprounzip_image_abc:latest'])])
+    assert dj.find_container(tmp_path).name == 'site'
+
+
+def test_find_container_in_registry_with_port(monkeypatch, tmp_path):
+    fake_docker(monkeypatch, b'localhost:5000/reprounzip_image_abc', [
+        ('site', ['localhost:5000/reprounzip_image_abc:latest'])])
+    assert dj.find_container(tmp_path).name == 'site'
+
+
+def make_rpz(path, data):
+    with tarfile.open(str(path), 'w:') as tar:
+        info = tarfile.TarInfo('DATA.tar.gz')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def test_package_digest_treats_corrupt_memo_as_miss(tmp_path):
+    rpz, memo = tmp_path / 'site.rpz', tmp_path / 'digests.json'
+    make_rpz(rpz, b'data')
+    memo.write_text('{"truncated')
+
+    digest = dj.package_digest(rpz, str(memo))
+    assert digest == hashlib.sha256(b'data').hexdigest()
+    assert list(json.loads(memo.read_text()).values()) == [digest]
+    assert dj.package_digest(rpz, str(memo)) == digest
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'digests.json', 'digests.json.lock', 'site.rpz']
+
+
+def test_concurrent_cache_updates_are_all_kept(tmp_path):
+    cache_file = str(tmp_path / 'images.json')
+
+    def touch(i):
+        with dj.cache_lock(cache_file):
+            used = dj.read_cache(cache_file)
+            used['tag{}'.format(i)] = i
+            dj.write_cache(cache_file, used)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(touch, range(50)))
+    assert dj.read_cache(cache_file) == dict(
+        ('tag{}'.format(i), i) for i in range(50))
@@ -0,0 +1,65 @@
+import asyncio
+
+from reprounzip.unpackers import dj
+
+
+def test_normalize_url():
+    assert dj.normalize_url('HTTP://Site.Example:80') == 'http://site.example/'
+    assert dj.normalize_url('https://site:443/a?b=2&a=1#top') == \
+        'https://site/a?a=1&b=2'
+    assert dj.normalize_url('http://site:8080/a?&x=1&') == \
+        'http://site:8080/a?x=1'
+
+
+def test_frontier_admits_each_url_once():
+    frontier = dj.Frontier(max_pages=10, max_depth=2,
+                           known=['http://site/known'])
+    assert frontier.add('http://site/a?y=1&x=2', 0)
+    assert not frontier.add('http://SITE:80/a?x=2&y=1#frag', 1)
+    assert not frontier.add('http://site/known', 1)
+    assert list(frontier.queue) == [('http://site/a?x=2&y=1', 0)]
+
+
+def test_frontier_limits_depth_and_pages():
+    frontier = dj.Frontier(max_pages=3, max_depth=1)
+    assert frontier.add('http://site/', 0)
+    assert frontier.add('http://site/1', 1)
+    assert not frontier.add('http://site/2', 2)
+    assert frontier.add('http://site/3', 1)
+    assert not frontier.add('http://site/4', 1)
+    assert len(frontier.queue) == 3
+
+
+def test_frontier_ends_when_nothing_is_pending():
+    async def crawl():
+        frontier = dj.Frontier(max_pages=10, max_depth=2)
+        frontier.add('http://site/', 0)
+        visited = []
+
+        async def worker():
+            while True:
+                item = await frontier.get()
+                if item is None:
+                    break
+                url, depth = item
+                visited.append(url)
+                await asyncio.sleep(0)
+                frontier.add(url + str(depth), depth + 1)
+                frontier.done()
+
+        await asyncio.gather(worker(), worker())
+        return visited
+
+    assert sorted(asyncio.run(crawl())) == [
+        'http://site/', 'http://site/0', 'http://site/01']
+
+
+def test_crawler_only_follows_same_origin_links():
+    crawler = dj.Crawler(None, 'http://Site:80/start')
+    assert crawler.same_origin('http://site/other?page=2')
+    assert not crawler.same_origin('https://site/')
+    assert not crawler.same_origin('http://site:8080/')
+    assert not crawler.same_origin('http://cdn.example/lib.js')
+    assert crawler.original_url(
+        'http://localhost:8080/warc-data/record/mp_/http://site/a') == \
+        'http://site/a'
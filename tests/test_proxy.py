@@ -0,0 +1,92 @@
+import http.client
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from reprounzip.unpackers import dj
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = '{} {} {}'.format(
+            self.server.name, self.path,
+            self.headers.get('X-Forwarded-Host', '-')).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstreams():
+    servers = []
+    for name in ('site', 'pywb'):
+        server = ThreadingHTTPServer(('localhost', 0), EchoHandler)
+        server.name = name
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield dict((server.name, ('localhost', server.server_address[1]))
+               for server in servers)
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def proxy(upstreams):
+    proxy = dj.ReplayProxy()
+    port = dj.free_ports(1)[0]
+    proxy.listen(port, {'rpzdj-repl.ay': upstreams['site']},
+                 upstreams['pywb'])
+    yield proxy, port
+    proxy.stop()
+
+
+def get(port, target, host):
+    conn = http.client.HTTPConnection('localhost', port, timeout=10)
+    try:
+        conn.request('GET', target, headers={'Host': host})
+        response = conn.getresponse()
+        return response.status, response.read().decode()
+    finally:
+        conn.close()
+
+
+def test_routes_server_name_to_site(proxy):
+    _, port = proxy
+    assert get(port, '/page?q=1', 'rpzdj-repl.ay') == (
+        200, 'site /page?q=1 rpzdj-repl.ay')
+    assert get(port, 'http://RPZDJ-REPL.AY:80/abs', 'ignored') == (
+        200, 'site /abs rpzdj-repl.ay')
+
+
+def test_routes_other_hosts_to_pywb_as_absolute_urls(proxy):
+    _, port = proxy
+    assert get(port, '/lib.js', 'cdn.example') == (
+        200, 'pywb http://cdn.example/lib.js -')
+
+
+def test_counts_requests_per_route(proxy):
+    proxy, port = proxy
+    get(port, '/', 'rpzdj-repl.ay')
+    get(port, '/', 'rpzdj-repl.ay')
+    get(port, '/', 'cdn.example')
+    stats = proxy.stats()
+    assert stats['{}:rpzdj-repl.ay'.format(port)]['requests'] == 2
+    assert stats['{}:pywb'.format(port)]['requests'] == 1
+
+
+def test_unreachable_upstream_is_bad_gateway():
+    proxy = dj.ReplayProxy()
+    port, closed = dj.free_ports(2)
+    proxy.listen(port, {}, ('localhost', closed))
+    try:
+        assert get(port, '/', 'cdn.example')[0] == 502
+    finally:
+        proxy.stop()
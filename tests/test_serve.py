@@ -0,0 +1,62 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from reprounzip.unpackers import dj
+
+
+class FakePool(object):
+    def __init__(self):
+        self.sessions = []
+
+    def session(self, pack, site_port):
+        self.sessions.append((pack, site_port))
+        return {'pack': pack}
+
+    def status(self):
+        return []
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    packs = tmp_path / 'packs'
+    packs.mkdir()
+    (packs / 'site.rpz').touch()
+    (tmp_path / 'outside.rpz').touch()
+    monkeypatch.setattr(dj.WarmPoolHandler, 'pool', FakePool())
+    monkeypatch.setattr(dj.WarmPoolHandler, 'pack_dir', str(packs))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), dj.WarmPoolHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, method, body=None, content_type='application/json'):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        headers = {'Content-Type': content_type} if body is not None else {}
+        conn.request(method, '/session', body, headers)
+        return conn.getresponse().status
+    finally:
+        conn.close()
+
+
+def test_session_needs_a_json_post(server):
+    assert request(server, 'GET') == 404
+    assert request(server, 'POST', 'pack=site.rpz',
+                   'application/x-www-form-urlencoded') == 415
+    assert request(server, 'POST', json.dumps(
+        {'pack': 'site.rpz', 'port': 3000})) == 200
+    assert dj.WarmPoolHandler.pool.sessions == [
+        (str(server.RequestHandlerClass.pack_dir) + '/site.rpz', 3000)]
+
+
+def test_session_only_for_packages_under_pack_dir(server):
+    for pack in ('../outside.rpz', '/etc/passwd', 'missing.rpz'):
+        assert request(server, 'POST', json.dumps({'pack': pack})) == 403
+    assert request(server, 'POST', '{"port": 80}') == 400
+    assert dj.WarmPoolHandler.pool.sessions == []
@@ -0,0 +1,75 @@
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from reprounzip.unpackers import dj
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(int(self.path.strip('/')))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def standalone(monkeypatch, tmp_path):
+    # the module monkey-patches the standard library for gevent and loads
+    # the app from ./config.yaml when it is imported
+    pywb_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'pywb')
+    shutil.copy(os.path.join(pywb_dir, 'standalone-config.yaml'),
+                str(tmp_path / 'config.yaml'))
+    (tmp_path / 'collections' / 'warc-data' / 'indexes').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('RPZ_METRICS_DIR', str(tmp_path / 'metrics'))
+    monkeypatch.syspath_prepend(pywb_dir)
+    import standalone
+    monkeypatch.setattr(standalone, 'metrics',
+                        standalone.Metrics(str(tmp_path / 'metrics')))
+    return standalone
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(('localhost', 0), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'localhost:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_live_loads_are_counted_per_backend(standalone, site, monkeypatch):
+    from pywb.warcserver.http import DefaultAdapters
+    from pywb.warcserver.resource.responseloader import (
+        LiveResourceException, LiveWebLoader)
+
+    monkeypatch.setattr(DefaultAdapters, 'live_adapter',
+                        standalone.BackendAdapter())
+    closed = 'localhost:{}'.format(dj.free_ports(1)[0])
+    loader = LiveWebLoader()
+    for url in ('http://{}/200'.format(site), 'http://{}/503'.format(site),
+                'http://{}/200'.format(closed)):
+        try:
+            loader._do_request('GET', url, None, {}, {}, True).release_conn()
+        except LiveResourceException:
+            pass
+
+    values = standalone.metrics.values
+    key = standalone.Metrics.key
+    assert values[key('rpz_live_requests_total',
+                      {'backend': site, 'result': 'ok'})] == 1
+    assert values[key('rpz_live_requests_total',
+                      {'backend': site, 'result': 'error'})] == 1
+    assert values[key('rpz_live_requests_total',
+                      {'backend': closed, 'result': 'error'})] == 1
+    assert values[key('rpz_live_request_seconds_count',
+                      {'backend': site})] == 2
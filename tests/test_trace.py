@@ -0,0 +1,26 @@
+import pytest
+
+from reprounzip.unpackers import dj
+
+
+def test_spans_nest_and_record_errors():
+    tracer = dj.Tracer()
+    with tracer.span('run') as attrs:
+        attrs['pack'] = 'site.rpz'
+        with pytest.raises(ValueError):
+            with tracer.span('load_page', url='http://site/'):
+                raise ValueError('boom')
+    run, page = tracer.spans
+    assert (run['parent'], run['outcome'], run['attrs']) == (
+        None, 'ok', {'pack': 'site.rpz'})
+    assert (page['parent'], page['outcome'], page['error']) == (
+        run['id'], 'error', 'boom')
+    assert set(tracer.totals()) == {'run', 'load_page'}
+
+
+def test_disabled_tracer_keeps_no_spans():
+    tracer = dj.Tracer(enabled=False)
+    with tracer.span('warm_up') as attrs:
+        attrs['bytes'] = 1
+        assert dj.Tracer.current.get() is None
+    assert tracer.spans == []
@@ -0,0 +1,197 @@
+import argparse
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+from reprounzip.unpackers import dj
+
+
+def write_warc(path, responses):
+    with open(str(path), 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        for url, body in responses:
+            headers = StatusAndHeaders('200 OK', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body)))], protocol='HTTP/1.0')
+            writer.write_record(writer.create_warc_record(
+                url, 'response', payload=io.BytesIO(body),
+                http_headers=headers))
+
+
+def read_records(path):
+    with open(str(path), 'rb') as f:
+        return [(r.rec_type, r.rec_headers.get_header('WARC-Target-URI'),
+                 r.rec_headers.get_header('WARC-Refers-To-Target-URI'))
+                for r in ArchiveIterator(f)]
+
+
+def make_rpz(path):
+    with tarfile.open(str(path), 'w:') as tar:
+        for name, data in [('METADATA/version', b'REPROZIP VERSION 2\n'),
+                           ('DATA.tar.gz', os.urandom(3000))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def pack(rpz, files):
+    packer = dj.WARCPacker(rpz)
+    for path in files:
+        packer.add(path)
+    packer.close()
+
+
+def test_index_offsets_match_tar_members(tmp_path):
+    rpz = tmp_path / 'site.rpz'
+    make_rpz(rpz)
+    files = []
+    for name, size in [('a.warc.gz', 700), ('b.warc.gz', 5000)]:
+        files.append(tmp_path / name)
+        files[-1].write_bytes(os.urandom(size))
+    pack(rpz, files)
+
+    index = dj.WARCIndex.read(rpz)
+    with tarfile.open(str(rpz)) as tar:
+        members = dict((m.name, m) for m in tar.getmembers())
+    assert sorted(index) == ['WARC_DATA/a.warc.gz', 'WARC_DATA/b.warc.gz']
+    for path in files:
+        name = 'WARC_DATA/' + path.name
+        offset, size, digest = index[name]
+        assert offset == members[name].offset_data
+        assert size == members[name].size
+        assert digest == hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def test_index_round_trip_with_incremental_pack(tmp_path):
+    rpz = tmp_path / 'site.rpz'
+    make_rpz(rpz)
+    first, second = tmp_path / 'a.warc.gz', tmp_path / 'b.warc.gz'
+    first.write_bytes(b'first' * 300)
+    second.write_bytes(b'second' * 300)
+    dj.WARCPacker.no_second_pass(rpz)
+    pack(rpz, [first])
+    with pytest.raises(dj.InvalidRPZ):
+        dj.WARCPacker.no_second_pass(rpz)
+    pack(rpz, [second])
+
+    target = tmp_path / 'target'
+    dj.RPZPackWithWARC.unpack_warc(rpz, target)
+    archive = target / 'collections' / 'warc-data' / 'archive'
+    assert (archive / 'a.warc.gz').read_bytes() == first.read_bytes()
+    assert (archive / 'b.warc.gz').read_bytes() == second.read_bytes()
+    # the package is still a valid tar archive
+    with tarfile.open(str(rpz)) as tar:
+        assert 'DATA.tar.gz' in tar.getnames()
+
+
+def test_no_second_pass_on_package_without_index(tmp_path):
+    rpz = tmp_path / 'site.rpz'
+    make_rpz(rpz)
+    dj.WARCPacker.no_second_pass(rpz)
+    # packages recorded before the index existed have bare WARC_DATA members
+    with tarfile.open(str(rpz), 'a:') as tar:
+        info = tarfile.TarInfo('WARC_DATA/a.warc.gz')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b'warc'))
+    with pytest.raises(dj.InvalidRPZ):
+        dj.WARCPacker.no_second_pass(rpz)
+
+
+def test_extract_detects_corrupt_member(tmp_path):
+    rpz = tmp_path / 'site.rpz'
+    make_rpz(rpz)
+    warc = tmp_path / 'a.warc.gz'
+    warc.write_bytes(b'x' * 2000)
+    pack(rpz, [warc])
+    offset = dj.WARCIndex.read(rpz)['WARC_DATA/a.warc.gz'][0]
+    with open(str(rpz), 'r+b') as f:
+        f.seek(offset + 10)
+        f.write(b'y')
+
+    with pytest.raises(dj.InvalidRPZ):
+        dj.RPZPackWithWARC.unpack_warc(rpz, tmp_path / 'target')
+    archive = tmp_path / 'target' / 'collections' / 'warc-data' / 'archive'
+    assert not (archive / 'a.warc.gz').exists()
+    assert not (archive / 'a.warc.gz.part').exists()
+
+
+def test_dedupe_stores_repeated_payloads_as_revisits(tmp_path):
+    src, dest = tmp_path / 'src.warc.gz', tmp_path / 'dest.warc.gz'
+    write_warc(src, [('http://site/a.js', b'same'),
+                     ('http://site/b.js', b'other'),
+                     ('http://site/c.js', b'same')])
+    dedup = dj.WARCDeduplicator()
+    dedup.dedupe(src, dest)
+
+    assert (dedup.responses, dedup.revisits) == (3, 1)
+    assert read_records(dest) == [
+        ('response', 'http://site/a.js', None),
+        ('response', 'http://site/b.js', None),
+        ('revisit', 'http://site/c.js', 'http://site/a.js')]
+
+
+def test_dedupe_seeded_from_packed_index(tmp_path):
+    old, new = tmp_path / 'old.warc.gz', tmp_path / 'new.warc.gz'
+    write_warc(old, [('http://site/a.js', b'same')])
+    index_path = tmp_path / 'autoindex.cdxj'
+    dj.write_cdxj(index_path, [old])
+
+    dedup = dj.WARCDeduplicator()
+    dedup.seed(index_path.read_bytes().splitlines())
+    write_warc(new, [('http://site/copy.js', b'same')])
+    dedup.dedupe(new, tmp_path / 'dest.warc.gz')
+
+    assert read_records(tmp_path / 'dest.warc.gz') == [
+        ('revisit', 'http://site/copy.js', 'http://site/a.js')]
+
+
+def test_zipnum_summary_lookup(tmp_path):
+    from pywb.warcserver.index.zipnum import ZipNumIndexSource
+
+    warc = tmp_path / 'a.warc.gz'
+    write_warc(warc, [('http://site/{:02}'.format(i), b'page %d' % i)
+                      for i in range(25)])
+    index_path = tmp_path / 'autoindex.cdxj'
+    dj.write_cdxj(index_path, [warc])
+    cluster, summary, loc = dj.write_zipnum(index_path, block_lines=10)
+
+    lines = index_path.read_bytes().splitlines(True)
+    entries = [line.split(b'\t') for line in
+               summary.read_bytes().splitlines()]
+    assert len(entries) == 3
+    data = cluster.read_bytes()
+    for i, (key, part, offset, length, lineno) in enumerate(entries):
+        block = gzip.decompress(data[int(offset):int(offset) + int(length)])
+        assert block == b''.join(lines[i * 10:(i + 1) * 10])
+        assert key == b' '.join(lines[i * 10].split(b' ', 2)[:2])
+        assert int(lineno) == i
+
+    source = ZipNumIndexSource(str(summary), None)
+    cdxs = list(source.load_index({'url': 'http://site/17'}))
+    assert [cdx['url'] for cdx in cdxs] == ['http://site/17']
+    assert list(source.load_index({'url': 'http://site/99'})) == []
+
+
+def test_failed_pack_leaves_package_unchanged(tmp_path, monkeypatch):
+    rpz = tmp_path / 'site.rpz'
+    make_rpz(rpz)
+    original = rpz.read_bytes()
+    archive = tmp_path / 'target' / 'collections' / 'warc-data' / 'archive'
+    archive.mkdir(parents=True)
+    write_warc(archive / 'a.warc.gz', [('http://site/', b'page')])
+
+    # fails once the WARC and its indexes were appended
+    monkeypatch.setattr(dj, 'profile_files',
+                        lambda path: [tmp_path / 'missing.har'])
+    args = argparse.Namespace(pack=[str(rpz)],
+                              target=[str(tmp_path / 'target')])
+    with pytest.raises(OSError):
+        dj.pack_it(args)
+    assert rpz.read_bytes() == original